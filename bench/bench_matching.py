@@ -0,0 +1,165 @@
+"""Tempo do agrupamento de ofertas iguais sobre as páginas salvas, em escala.
+
+    python bench/bench_matching.py --copias 1,4,8,16,32 --repeticoes 3
+
+Cada cópia das fixtures troca o número do modelo (4060 -> 4070, 3060...),
+a caixa e o ruído do título e ganha links e preços próprios, então o
+conjunto cresce em ofertas e em produtos distintos. "frio" calcula a
+assinatura de cada título; "quente" já a encontra no memo, como numa busca
+repetida. Compara o agrupamento com blocos e índice de palavras com a
+comparação de todos os pares (até --todos-os-pares-ate ofertas, a frio) e
+confere se os dois chegam aos mesmos grupos.
+
+Isso só prova que os blocos e o índice não perdem pares. Para a regra em si,
+PARES_ROTULADOS traz títulos reais de placas de vídeo, SSDs, memórias e
+celulares marcados como mesmo produto ou não; eles são agrupados junto com as
+fixtures, e o relatório aponta os que erram.
+"""
+import argparse
+import itertools
+import random
+import statistics
+import math
+import time
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+from bench_parse import EXTRATORES, carregar_paginas  # noqa: E402
+
+MODELOS = ["4060", "4070", "3060", "3070", "4080", "3050", "4090", "3080"]
+RUIDO = ["", " Novo", " Original", " Lacrado"]
+
+# (categoria, mesmo produto?, título numa loja, título em outra)
+PARES_ROTULADOS = [
+    # Placas de vídeo
+    ("gpu", True, "Placa de Vídeo RTX 4060 Ventus 2X Black OC MSI NVIDIA GeForce, 8GB GDDR6, DLSS, Ray Tracing",
+                  "Placa de Video MSI GeForce RTX 4060 VENTUS 2X BLACK 8G OC, 8GB GDDR6, 128-bit"),
+    ("gpu", True, "Placa de Vídeo Gigabyte RTX 4060 WINDFORCE OC 8GB GDDR6",
+                  "Placa de Video Gigabyte NVIDIA GeForce RTX 4060 Windforce OC, 8GB, GDDR6, 128 bits"),
+    ("gpu", False, "Placa de Vídeo MSI RTX 4060 Ventus 2X Black OC 8GB", "Placa de Vídeo MSI RTX 4060 Ti Ventus 2X Black OC 8GB"),
+    ("gpu", False, "Placa de Vídeo MSI RTX 4060 Ventus 2X Black OC 8GB", "Placa de Vídeo Asus RTX 4060 Dual OC 8GB"),
+    ("gpu", False, "Placa de Vídeo Gigabyte RTX 4060 Windforce OC 8GB", "Placa de Vídeo Gigabyte RTX 4070 Windforce OC 12GB"),
+    ("gpu", False, "Placa de Vídeo RTX 4060 Ti Gaming OC Gigabyte 8GB", "Placa de Vídeo RTX 4060 Ti Gaming OC Gigabyte 16GB"),
+    # SSDs
+    ("ssd", True, "SSD Kingston NV2 1TB M.2 NVMe", "SSD Kingston NV2, 1TB, M.2 2280 PCIe NVMe"),
+    ("ssd", True, "SSD Kingston NV2 1TB, M.2 2280, PCIe 4.0 NVMe, Leitura 3500MB/s, Gravação 2100MB/s",
+                  "SSD 1TB Kingston NV2 M.2 NVMe Leitura: 3.500 MB/s"),
+    ("ssd", True, "SSD Crucial P3 Plus 500GB M.2 NVMe Gen4", "SSD Crucial P3 Plus 500GB, M.2 2280, PCIe Gen4 NVMe, Até 4700MB/s"),
+    ("ssd", False, "SSD Kingston NV2 1TB M.2 NVMe", "SSD Kingston NV2 500GB M.2 NVMe"),
+    ("ssd", False, "SSD Kingston NV2 1TB M.2 NVMe", "SSD Kingston NV3 1TB M.2 NVMe"),
+    ("ssd", False, "SSD Crucial P3 Plus 500GB M.2 NVMe", "SSD Crucial P3 500GB M.2 NVMe"),
+    # Memória RAM
+    ("ram", True, "Memória Kingston Fury Beast 16GB 3200MHz DDR4 CL16", "Memória RAM Kingston Fury Beast, 16GB, DDR4, 3200 MHz, CL16"),
+    ("ram", True, "Memória Corsair Vengeance LPX 8GB 2666MHz DDR4", "Memoria Corsair Vengeance LPX, 8GB, 2666 MHz, DDR4, Preto"),
+    ("ram", False, "Memória Kingston Fury Beast 16GB 3200MHz DDR4", "Memória Kingston Fury Beast 16GB 3600MHz DDR4"),
+    ("ram", False, "Memória Kingston Fury Beast 16GB 3200MHz DDR4", "Memória Kingston Fury Beast 8GB 3200MHz DDR4"),
+    ("ram", False, "Memória Kingston Fury Beast 16GB 3200MHz DDR4", "Memória Kingston Fury Beast 16GB 5200MHz DDR5"),
+    # Celulares
+    ("celular", True, "Smartphone Samsung Galaxy A55 5G 256GB 8GB RAM Azul", "Samsung Galaxy A55 5G 8GB RAM 256GB Azul"),
+    ("celular", True, "Celular Motorola Moto G84 5G 256GB 8GB RAM Grafite", "Smartphone Motorola Moto G84 5G, 8GB RAM, 256GB, Grafite"),
+    ("celular", False, "Smartphone Samsung Galaxy A55 5G 256GB 8GB RAM", "Smartphone Samsung Galaxy A35 5G 256GB 8GB RAM"),
+    ("celular", False, "Smartphone Samsung Galaxy A55 5G 256GB 8GB RAM", "Smartphone Samsung Galaxy A55 5G 128GB 8GB RAM"),
+    ("celular", False, "Smartphone Samsung Galaxy A55 5G 256GB 8GB RAM", "Smartphone Samsung Galaxy A55 5G 256GB 12GB RAM"),
+    ("celular", False, "Celular Motorola Moto G84 5G 256GB 8GB RAM", "Celular Motorola Moto G54 5G 256GB 8GB RAM"),
+]
+
+def ofertas_gravadas(pasta):
+    produtos = []
+    for loja, html in carregar_paginas(pasta).items():
+        produtos.extend(EXTRATORES[loja](html))
+    return main.deduplicar(produtos, set())
+
+def escalar(base, copias, semente=42):
+    """`copias` versões das ofertas gravadas, cada uma com outro modelo e outra grafia."""
+    aleatorio = random.Random(semente)
+    ofertas = []
+    for k in range(copias):
+        modelo = MODELOS[k % len(MODELOS)]
+        for p in base:
+            nome = p['nome'].replace("4060", modelo) + aleatorio.choice(RUIDO)
+            if aleatorio.random() < 0.3: nome = nome.upper()
+            ofertas.append({**p, "nome": nome, "link": f"{p['link']}#{k}", "preco": round(p['preco'] * aleatorio.uniform(0.9, 1.1), 2)})
+    return ofertas
+
+def agrupar_todos_os_pares(produtos, limiar=main.AGRUPAR_LIMIAR):
+    """Referência quadrática: mesma regra de semelhança, sem blocos nem índice."""
+    assinaturas = [main.assinatura_oferta(p['nome']) for p in produtos]
+    frequencia = {}
+    for _, linha in assinaturas:
+        for t in linha: frequencia[t] = frequencia.get(t, 0) + 1
+    pesos = {t: math.log((len(produtos) + 1) / f) for t, f in frequencia.items()}
+    conjuntos = main._Conjuntos(len(produtos))
+    for a, b in itertools.combinations(range(len(produtos)), 2):
+        if assinaturas[a][0] == assinaturas[b][0] and main._semelhanca(assinaturas[a][1], assinaturas[b][1], pesos) >= limiar:
+            conjuntos.unir(a, b)
+    return [conjuntos.raiz(i) for i in range(len(produtos))]
+
+def particao(grupos):
+    membros = {}
+    for i, g in enumerate(grupos): membros.setdefault(g, set()).add(i)
+    return {frozenset(m) for m in membros.values()}
+
+def medir(funcao, repeticoes):
+    tempos, resultado = [], None
+    for _ in range(repeticoes):
+        inicio = time.perf_counter()
+        resultado = funcao()
+        tempos.append((time.perf_counter() - inicio) * 1000)
+    return statistics.median(tempos), resultado
+
+def conferir_rotulados(base, pares=PARES_ROTULADOS):
+    """Agrupa os pares rotulados junto com `base` e devolve os que erraram."""
+    ofertas = list(base)
+    for k, (_, _, a, b) in enumerate(pares):
+        ofertas.append({"nome": a, "link": f"rotulado:{k}:a", "preco": 1.0, "loja": "a"})
+        ofertas.append({"nome": b, "link": f"rotulado:{k}:b", "preco": 1.0, "loja": "b"})
+    grupos = main.agrupar_ofertas(ofertas)
+    n = len(base)
+    return [par for k, par in enumerate(pares) if (grupos[n + 2 * k] == grupos[n + 2 * k + 1]) != par[1]]
+
+def principal():
+    parser = argparse.ArgumentParser(description="Benchmark do agrupamento de ofertas iguais")
+    parser.add_argument("--copias", default="1,4,8,16,32", help="tamanhos a medir, em cópias das fixtures")
+    parser.add_argument("--repeticoes", type=int, default=3)
+    parser.add_argument("--todos-os-pares-ate", type=int, default=2000, help="maior conjunto comparado com a referência quadrática")
+    parser.add_argument("--mostrar", type=int, default=0, metavar="N", help="imprime os N grupos com mais lojas do primeiro tamanho")
+    parser.add_argument("--fixtures", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures"))
+    args = parser.parse_args()
+
+    base = ofertas_gravadas(args.fixtures)
+    erros = conferir_rotulados(base)
+    print(f"🏷️ pares rotulados: {len(PARES_ROTULADOS) - len(erros)}/{len(PARES_ROTULADOS)} certos")
+    for categoria, mesmo, a, b in erros:
+        print(f"   ❌ {categoria}: {'deviam juntar' if mesmo else 'não deviam juntar'}: {a!r} / {b!r}")
+    print(f"{'ofertas':>8} {'grupos':>7} {'blocos':>7} {'pares':>9} {'frio':>10} {'quente':>10} {'todos pares':>12} {'pares':>10}  iguais")
+    for copias in map(int, args.copias.split(",")):
+        ofertas = escalar(base, copias)
+        estatisticas = {}
+        # Assinaturas a frio: o memo por título não pode vir aquecido da repetição anterior
+        def agrupar():
+            main.assinatura_oferta.cache_clear()
+            return main.agrupar_ofertas(ofertas, estatisticas=estatisticas)
+        ms, grupos = medir(agrupar, args.repeticoes)
+        main.assinatura_oferta.cache_clear()
+        ms_quente, _ = medir(lambda: main.agrupar_ofertas(ofertas), args.repeticoes)
+        linha = f"{len(ofertas):>8} {len(set(grupos)):>7} {estatisticas['blocos']:>7} {estatisticas['comparados']:>9} {ms:>8.1f}ms {ms_quente:>8.1f}ms"
+        if len(ofertas) <= args.todos_os_pares_ate:
+            main.assinatura_oferta.cache_clear()
+            ms_ref, referencia = medir(lambda: agrupar_todos_os_pares(ofertas), 1)
+            pares = len(ofertas) * (len(ofertas) - 1) // 2
+            linha += f" {ms_ref:>10.1f}ms {pares:>10}  {'sim' if particao(grupos) == particao(referencia) else 'NÃO'}"
+        print(linha)
+
+        if args.mostrar and copias == int(args.copias.split(",")[0]):
+            membros = {}
+            for p, g in zip(ofertas, grupos): membros.setdefault(g, []).append(p)
+            for g in sorted(membros, key=lambda g: -len({p['loja'] for p in membros[g]}))[:args.mostrar]:
+                ps = sorted(membros[g], key=lambda p: p['preco'])
+                print(f"   🏷️ {ps[0]['nome'][:70]}  {len(ps)} ofertas, de {ps[0]['preco']:.2f} a {ps[-1]['preco']:.2f}")
+                for p in ps: print(f"      {p['loja']:<14} {p['preco']:>9.2f}  {p['nome'][:70]}")
+
+if __name__ == "__main__":
+    principal()
@@ -0,0 +1,105 @@
+"""Tempo de parse por página salva, antes e depois das otimizações de parse.
+
+    python bench/bench_parse.py --repeticoes 20
+
+"antes" é o html.parser montando a página inteira; "depois" é o backend
+configurado (lxml por padrão) só com os contêineres de produto. Também mede
+quanto o event loop fica travado com as seis lojas terminando juntas, com o
+parse no loop e no executor.
+"""
+import argparse
+import asyncio
+import statistics
+import time
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+EXTRATORES = {
+    "ml": main.extrair_mercadolivre,
+    "amazon": main.extrair_amazon,
+    "kabum": main.extrair_kabum,
+    "magalu": main.extrair_magalu,
+    "pichau": main.extrair_pichau,
+    "terabyte": main.extrair_terabyte,
+}
+
+def carregar_paginas(pasta):
+    paginas = {}
+    for loja in EXTRATORES:
+        with open(os.path.join(pasta, f"{loja}.html"), encoding="utf-8") as f:
+            paginas[loja] = f.read()
+    return paginas
+
+def medir(extrair, html, repeticoes):
+    tempos = []
+    for _ in range(repeticoes):
+        inicio = time.perf_counter()
+        itens = extrair(html)
+        tempos.append((time.perf_counter() - inicio) * 1000)
+    return statistics.median(tempos), len(itens)
+
+def configurar(parser, filtro):
+    main.PARSER_HTML = parser
+    main.USAR_FILTRO_PARSE = filtro
+
+async def lag_do_loop(paginas, executor):
+    """Maior atraso de um tique de 1 ms enquanto as seis páginas são extraídas."""
+    main.EXECUTOR_PARSE = executor
+    main.fechar_executor_parse()
+    await main.aquecer_parse()
+    pior = 0.0
+    rodando = True
+
+    async def relogio():
+        nonlocal pior
+        while rodando:
+            antes = time.perf_counter()
+            await asyncio.sleep(0.001)
+            pior = max(pior, (time.perf_counter() - antes - 0.001) * 1000)
+
+    tique = asyncio.create_task(relogio())
+    await asyncio.sleep(0.01)
+    inicio = time.perf_counter()
+    await asyncio.gather(*[main.extrair_fora_do_loop(EXTRATORES[loja], html) for loja, html in paginas.items()])
+    total = (time.perf_counter() - inicio) * 1000
+    rodando = False
+    await tique
+    main.fechar_executor_parse()
+    return total, pior
+
+def principal():
+    parser = argparse.ArgumentParser(description="Benchmark de parse das páginas de busca")
+    parser.add_argument("--repeticoes", type=int, default=10)
+    parser.add_argument("--fixtures", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures"))
+    args = parser.parse_args()
+
+    paginas = carregar_paginas(args.fixtures)
+    backend = main.PARSER_HTML
+    cenarios = [("antes", "html.parser", False), ("filtro", "html.parser", True), (backend, backend, False), ("depois", backend, True)]
+
+    print(f"{'loja':<10} {'KB':>6}" + "".join(f" {nome:>12}" for nome, _, _ in cenarios) + "   itens")
+    totais = {nome: 0.0 for nome, _, _ in cenarios}
+    for loja, html in paginas.items():
+        linha = f"{loja:<10} {len(html) // 1024:>6}"
+        contagens = set()
+        for nome, backend_html, filtro in cenarios:
+            configurar(backend_html, filtro)
+            ms, n = medir(EXTRATORES[loja], html, args.repeticoes)
+            totais[nome] += ms
+            contagens.add(n)
+            linha += f" {ms:>10.2f}ms"
+        print(linha + f"   {'/'.join(map(str, sorted(contagens)))}")
+    print(f"{'total':<17}" + "".join(f" {totais[nome]:>10.2f}ms" for nome, _, _ in cenarios))
+
+    configurar(backend, True)
+    print("\nSeis páginas extraídas ao mesmo tempo (ms):")
+    for executor in ("loop", "thread", "processo"):
+        total, pior = asyncio.run(lag_do_loop(paginas, executor))
+        print(f"  {executor:<9} total {total:>8.2f}   maior travada do loop {pior:>8.2f}")
+
+if __name__ == "__main__":
+    principal()
@@ -0,0 +1,233 @@
+"""Benchmark de ponta a ponta contra o replay local, sem tocar nas lojas de verdade.
+
+    python bench/bench_pipeline.py --alvo paralelo --buscas 60 --concorrencia 6 --atraso 200
+    python bench/bench_pipeline.py --alvo api --salvar-base bench/baselines/atual.json
+    python bench/bench_pipeline.py --comparar bench/baselines/atual.json
+
+--alvo paralelo chama buscar_paralelo no mesmo processo; --alvo api sobe o
+uvicorn numa thread e faz GET /api/buscar. Cada busca usa um termo diferente
+para não cair no cache (use --com-cache para medir o caso quente). Mostra
+p50/p95/p99, vazão, tempo por etapa (lancar, aba, http, goto, content, parse)
+e pico de RSS do processo e dos filhos (Chromium, workers de parse).
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import threading
+import time
+
+PASTA_BENCH = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, PASTA_BENCH)
+sys.path.insert(0, os.path.dirname(PASTA_BENCH))
+
+from replay import iniciar_replay, ler_atrasos_por_loja  # noqa: E402
+
+def percentil(valores, p):
+    if not valores: return 0.0
+    ordenados = sorted(valores)
+    k = (len(ordenados) - 1) * p / 100
+    baixo = int(k)
+    alto = min(baixo + 1, len(ordenados) - 1)
+    return ordenados[baixo] + (ordenados[alto] - ordenados[baixo]) * (k - baixo)
+
+def resumo(valores):
+    return {
+        "n": len(valores),
+        "p50": percentil(valores, 50),
+        "p95": percentil(valores, 95),
+        "p99": percentil(valores, 99),
+        "media": statistics.fmean(valores) if valores else 0.0,
+    }
+
+# --- PICO DE MEMÓRIA ---
+
+def _rss_kb(pid):
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for linha in f:
+                if linha.startswith("VmRSS:"): return int(linha.split()[1])
+    except OSError:
+        pass
+    return 0
+
+def rss_arvore_kb(raiz=None):
+    """RSS somado do processo e de todos os descendentes (Linux, via /proc)."""
+    raiz = raiz or os.getpid()
+    filhos = {}
+    for nome in os.listdir("/proc"):
+        if not nome.isdigit(): continue
+        try:
+            with open(f"/proc/{nome}/stat") as f:
+                ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        filhos.setdefault(ppid, []).append(int(nome))
+    total, pilha = 0, [raiz]
+    while pilha:
+        pid = pilha.pop()
+        total += _rss_kb(pid)
+        pilha.extend(filhos.get(pid, []))
+    return total
+
+class MonitorRSS(threading.Thread):
+    def __init__(self, intervalo=0.1):
+        super().__init__(daemon=True)
+        self.intervalo = intervalo
+        self.pico_kb = 0
+        self._parar = threading.Event()
+
+    def run(self):
+        while not self._parar.is_set():
+            self.pico_kb = max(self.pico_kb, rss_arvore_kb())
+            self._parar.wait(self.intervalo)
+
+    def parar(self):
+        self._parar.set()
+        self.join()
+        self.pico_kb = max(self.pico_kb, rss_arvore_kb())
+
+# --- CARGA ---
+
+async def disparar(executar, buscas, concorrencia, com_cache):
+    latencias, erros = [], 0
+    fila = asyncio.Queue()
+    for i in range(buscas): fila.put_nowait("rtx 4060" if com_cache else f"rtx 4060 {i}")
+
+    async def trabalhador():
+        nonlocal erros
+        while not fila.empty():
+            termo = fila.get_nowait()
+            inicio = time.perf_counter()
+            try:
+                await executar(termo)
+            except Exception as e:
+                erros += 1
+                print(f"   ❌ {termo}: {e!r:.120}")
+                continue
+            latencias.append(time.perf_counter() - inicio)
+
+    inicio = time.perf_counter()
+    await asyncio.gather(*[trabalhador() for _ in range(concorrencia)])
+    return latencias, erros, time.perf_counter() - inicio
+
+async def rodar_paralelo(main, args):
+    async def executar(termo):
+        return await main.buscar_paralelo(termo, args.lojas.split(","))
+    try:
+        # Aquece pool de navegadores e workers de parse fora da medição; o lançamento fica em "etapas"
+        if main.usa_navegador(): await main.pool.iniciar()
+        await main.aquecer_parse()
+        return await disparar(executar, args.buscas, args.concorrencia, args.com_cache)
+    finally:
+        await main.fechar_cliente_http()
+        main.fechar_executor_parse()
+        await main.pool.fechar()
+
+async def rodar_api(main, args):
+    import httpx
+    import uvicorn
+    servidor = uvicorn.Server(uvicorn.Config(main.app, host="127.0.0.1", port=args.porta_api, log_level="warning"))
+    thread = threading.Thread(target=servidor.run, daemon=True)
+    thread.start()
+    while not servidor.started: await asyncio.sleep(0.05)
+    try:
+        async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{args.porta_api}", timeout=120) as cliente:
+            async def executar(termo):
+                resposta = await cliente.get("/api/buscar", params={"q": termo, "lojas": args.lojas})
+                resposta.raise_for_status()
+            return await disparar(executar, args.buscas, args.concorrencia, args.com_cache)
+    finally:
+        servidor.should_exit = True
+        thread.join()
+
+# --- RELATÓRIO E BASELINES ---
+
+def imprimir(relatorio):
+    lat = relatorio["latencia_ms"]
+    print(f"\n🏁 {relatorio['alvo']}: {lat['n']} buscas, concorrência {relatorio['config']['concorrencia']}, {relatorio['erros']} erros")
+    print(f"   latência  p50 {lat['p50']:.1f} ms   p95 {lat['p95']:.1f} ms   p99 {lat['p99']:.1f} ms")
+    print(f"   vazão     {relatorio['vazao_rps']:.2f} buscas/s")
+    print(f"   pico RSS  {relatorio['pico_rss_mb']:.1f} MB")
+    print(f"   {'etapa':<10} {'n':>6} {'p50 ms':>9} {'p95 ms':>9} {'média ms':>9}")
+    for etapa, r in sorted(relatorio["etapas_ms"].items()):
+        print(f"   {etapa:<10} {r['n']:>6} {r['p50']:>9.1f} {r['p95']:>9.1f} {r['media']:>9.1f}")
+
+def comparar(atual, base, tolerancia):
+    """Compara com um baseline salvo; devolve True se algo piorou além da tolerância (%)."""
+    print(f"\n📏 Comparando com baseline ({base['config']})")
+    piorou = False
+    metricas = [("latência p50", atual["latencia_ms"]["p50"], base["latencia_ms"]["p50"], False),
+                ("latência p95", atual["latencia_ms"]["p95"], base["latencia_ms"]["p95"], False),
+                ("latência p99", atual["latencia_ms"]["p99"], base["latencia_ms"]["p99"], False),
+                ("vazão", atual["vazao_rps"], base["vazao_rps"], True),
+                ("pico RSS", atual["pico_rss_mb"], base["pico_rss_mb"], False)]
+    for etapa in sorted(set(atual["etapas_ms"]) & set(base["etapas_ms"])):
+        metricas.append((f"{etapa} p50", atual["etapas_ms"][etapa]["p50"], base["etapas_ms"][etapa]["p50"], False))
+    for nome, agora, antes, maior_melhor in metricas:
+        delta = (agora - antes) / antes * 100 if antes else 0.0
+        regressao = (-delta if maior_melhor else delta) > tolerancia
+        piorou |= regressao
+        print(f"   {nome:<14} {antes:>10.2f} -> {agora:>10.2f}  ({delta:+.1f}%){'  ⚠️ REGRESSÃO' if regressao else ''}")
+    return piorou
+
+def principal():
+    parser = argparse.ArgumentParser(description="Benchmark offline do pipeline de busca")
+    parser.add_argument("--alvo", choices=["paralelo", "api"], default="paralelo")
+    parser.add_argument("--buscas", type=int, default=30)
+    parser.add_argument("--concorrencia", type=int, default=4)
+    parser.add_argument("--lojas", default="todas")
+    parser.add_argument("--com-cache", action="store_true", help="repete o mesmo termo e deixa o cache agir")
+    parser.add_argument("--modos", default="ml=http,amazon=http,kabum=http,magalu=http,pichau=http,terabyte=http",
+                        help="PRECIN_MODOS usado na medição (padrão: tudo por HTTP, sem Chromium)")
+    parser.add_argument("--atraso", type=float, default=0, help="atraso em ms injetado pelo replay")
+    parser.add_argument("--atraso-loja", action="append", metavar="LOJA=MS")
+    parser.add_argument("--jitter", type=float, default=0)
+    parser.add_argument("--porta-api", type=int, default=8799)
+    parser.add_argument("--salvar-base", metavar="ARQUIVO")
+    parser.add_argument("--comparar", metavar="ARQUIVO")
+    parser.add_argument("--tolerancia", type=float, default=10, help="piora máxima (%%) antes de acusar regressão")
+    args = parser.parse_args()
+
+    _, url = iniciar_replay(atraso=args.atraso, atraso_por_loja=ler_atrasos_por_loja(args.atraso_loja), jitter=args.jitter)
+    # O main lê estas variáveis ao ser importado, e os workers de parse (spawn) herdam o ambiente
+    os.environ["PRECIN_REPLAY_URL"] = url
+    os.environ["PRECIN_MODOS"] = args.modos
+    # Banco de ofertas em memória: a medição não suja nem reaproveita o precin.db local
+    os.environ.setdefault("PRECIN_BANCO", ":memory:")
+    import main
+
+    etapas = {}
+    main.observadores_etapas.append(lambda loja, etapa, s: etapas.setdefault(etapa, []).append(s * 1000))
+
+    monitor = MonitorRSS()
+    monitor.start()
+    rodar = rodar_paralelo if args.alvo == "paralelo" else rodar_api
+    latencias, erros, duracao = asyncio.run(rodar(main, args))
+    monitor.parar()
+
+    relatorio = {
+        "alvo": args.alvo,
+        "config": {"buscas": args.buscas, "concorrencia": args.concorrencia, "lojas": args.lojas, "com_cache": args.com_cache,
+                   "modos": args.modos, "atraso": args.atraso, "atraso_loja": args.atraso_loja, "jitter": args.jitter},
+        "latencia_ms": resumo([s * 1000 for s in latencias]),
+        "vazao_rps": len(latencias) / duracao if duracao else 0.0,
+        "erros": erros,
+        "pico_rss_mb": monitor.pico_kb / 1024,
+        "etapas_ms": {etapa: resumo(valores) for etapa, valores in etapas.items()},
+    }
+    imprimir(relatorio)
+
+    if args.salvar_base:
+        os.makedirs(os.path.dirname(os.path.abspath(args.salvar_base)), exist_ok=True)
+        with open(args.salvar_base, "w") as f:
+            json.dump(relatorio, f, indent=2, ensure_ascii=False)
+        print(f"\n💾 baseline salvo em {args.salvar_base}")
+    if args.comparar:
+        with open(args.comparar) as f:
+            if comparar(relatorio, json.load(f), args.tolerancia): sys.exit(1)
+
+if __name__ == "__main__":
+    principal()
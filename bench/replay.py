@@ -0,0 +1,128 @@
+"""Servidor local que faz o papel das lojas, servindo páginas de busca salvas.
+
+Cada loja fica num prefixo (/ml/..., /amazon/..., ...) e qualquer busca nela
+devolve bench/fixtures/<loja>.html, com atraso opcional. Para apontar o
+Precin para cá:
+
+    python bench/replay.py --porta 8765 --atraso 300 --atraso-loja terabyte=2000
+    PRECIN_REPLAY_URL=http://127.0.0.1:8765 python main.py
+
+Para regravar as fixtures a partir das lojas de verdade:
+
+    python bench/replay.py --gravar "rtx 4060"
+"""
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import argparse
+import threading
+import random
+import gzip
+import time
+import os
+import sys
+
+PASTA_FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+def carregar_fixtures(pasta=PASTA_FIXTURES):
+    paginas = {}
+    for arquivo in os.listdir(pasta):
+        if arquivo.endswith(".html"):
+            with open(os.path.join(pasta, arquivo), "rb") as f:
+                paginas[arquivo[:-5]] = f.read()
+    return paginas
+
+class ReplayHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    paginas = {}
+    # Atraso em ms: padrão para todas as lojas, sobrescrito por loja, mais um jitter aleatório
+    atraso = 0
+    atraso_por_loja = {}
+    jitter = 0
+
+    def do_GET(self):
+        loja = self.path.lstrip("/").split("/")[0].split("?")[0]
+        corpo = self.paginas.get(loja)
+        if corpo is None:
+            self.send_error(404)
+            return
+        espera = self.atraso_por_loja.get(loja, self.atraso) + random.uniform(0, self.jitter)
+        if espera: time.sleep(espera / 1000)
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        if "gzip" in self.headers.get("Accept-Encoding", ""):
+            corpo = gzip.compress(corpo, compresslevel=5)
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(corpo)))
+        self.end_headers()
+        try:
+            self.wfile.write(corpo)
+        except (BrokenPipeError, ConnectionResetError):
+            # Cliente desistiu antes (timeout do teste ou do Precin)
+            pass
+
+    def log_message(self, *args):
+        pass
+
+def criar_servidor(porta=0, pasta=PASTA_FIXTURES, atraso=0, atraso_por_loja=None, jitter=0):
+    handler = type("Handler", (ReplayHandler,), {
+        "paginas": carregar_fixtures(pasta),
+        "atraso": atraso,
+        "atraso_por_loja": atraso_por_loja or {},
+        "jitter": jitter,
+    })
+    servidor = ThreadingHTTPServer(("127.0.0.1", porta), handler)
+    servidor.daemon_threads = True
+    return servidor
+
+def iniciar_replay(porta=0, pasta=PASTA_FIXTURES, **atrasos):
+    """Sobe o servidor numa thread e devolve (servidor, url_base)."""
+    servidor = criar_servidor(porta, pasta, **atrasos)
+    threading.Thread(target=servidor.serve_forever, daemon=True).start()
+    return servidor, f"http://127.0.0.1:{servidor.server_address[1]}"
+
+def ler_atrasos_por_loja(pares):
+    atrasos = {}
+    for par in pares or []:
+        loja, ms = par.split("=")
+        atrasos[loja.strip()] = float(ms)
+    return atrasos
+
+async def gravar(produto, pasta):
+    """Baixa a busca de cada loja pelo mesmo caminho do Precin e salva como fixture."""
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import main
+    try:
+        for loja in main.LOJAS:
+            url = main.montar_url(loja, produto)
+            try:
+                if main.MODOS_BUSCA.get(loja) == "navegador":
+                    content = await main.baixar_navegador(loja, main.pool, url, 30000)
+                else:
+                    content = await main.baixar_http(loja, url)
+            except Exception as e:
+                print(f"   ❌ {loja}: {e!r:.120}")
+                continue
+            with open(os.path.join(pasta, f"{loja}.html"), "w", encoding="utf-8") as f:
+                f.write(content)
+            print(f"   💾 {loja}: {len(content) // 1024} KB")
+    finally:
+        await main.fechar_cliente_http()
+        await main.pool.fechar()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay local das páginas de busca das lojas")
+    parser.add_argument("--porta", type=int, default=8765)
+    parser.add_argument("--fixtures", default=PASTA_FIXTURES)
+    parser.add_argument("--atraso", type=float, default=0, help="atraso em ms de toda resposta")
+    parser.add_argument("--atraso-loja", action="append", metavar="LOJA=MS", help="atraso de uma loja específica")
+    parser.add_argument("--jitter", type=float, default=0, help="até quantos ms aleatórios somar ao atraso")
+    parser.add_argument("--gravar", metavar="BUSCA", help="regrava as fixtures buscando nas lojas de verdade")
+    args = parser.parse_args()
+
+    if args.gravar:
+        import asyncio
+        asyncio.run(gravar(args.gravar, args.fixtures))
+        sys.exit(0)
+
+    servidor = criar_servidor(args.porta, args.fixtures, args.atraso, ler_atrasos_por_loja(args.atraso_loja), args.jitter)
+    print(f"🎞️ REPLAY: {', '.join(sorted(servidor.RequestHandlerClass.paginas))} em http://127.0.0.1:{args.porta}")
+    servidor.serve_forever()
@@ -1,21 +1,78 @@
-from fastapi import FastAPI
+from fastapi import FastAPI, Response, Query, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
-from playwright.async_api import async_playwright
-from bs4 import BeautifulSoup
+from fastapi.responses import FileResponse, StreamingResponse, PlainTextResponse, JSONResponse
+from playwright.async_api import async_playwright, TimeoutError as PlaywrightTimeout
+from bs4 import BeautifulSoup, SoupStrainer
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from urllib.parse import urlsplit
+from contextlib import asynccontextmanager, contextmanager
+from collections import OrderedDict
+from pydantic import BaseModel, Field
 import uvicorn
+import httpx
 import asyncio
+import argparse
+import unicodedata
+import itertools
+import functools
+import math
+import contextvars
+import multiprocessing
+import sqlite3
+import json
+import time
 import re
+import sys
 import os
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app):
+    # Navegadores sobem junto com a API e ficam quentes entre as buscas
+    # (se toda loja estiver no modo "http", o pool só sobe se alguém pedir uma aba)
+    if usa_navegador(): await pool.iniciar()
+    # Sobe todos os workers de parse agora, não nas primeiras buscas
+    await aquecer_parse()
+    await armazem.abrir()
+    aquecedor.iniciar()
+    yield
+    await aquecedor.parar()
+    await armazem.fechar()
+    await fechar_cliente_http()
+    fechar_executor_parse()
+    await pool.fechar()
+
+# JSON compacto: orjson quando instalado, senão json sem espaços
+try:
+    import orjson
+    def json_compacto(dados): return orjson.dumps(dados)
+except ImportError:
+    def json_compacto(dados): return json.dumps(dados, ensure_ascii=False, separators=(",", ":")).encode()
+
+class RespostaCompacta(JSONResponse):
+    def render(self, content):
+        return json_compacto(content)
+
+class GZipSemFluxo(GZipMiddleware):
+    """GZip em tudo menos no NDJSON, onde o compressor seguraria as linhas e mataria a entrega incremental."""
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["path"].endswith(("/stream", "/lote")):
+            return await self.app(scope, receive, send)
+        await super().__call__(scope, receive, send)
+
+app = FastAPI(lifespan=lifespan, default_response_class=RespostaCompacta)
+
+app.add_middleware(GZipSemFluxo, minimum_size=1000)
 
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
     allow_methods=["*"],
     allow_headers=["*"],
+    # Sem isto um front em outra origem não consegue ler estes cabeçalhos
+    expose_headers=["X-Lojas-Incompletas", "Retry-After"],
 )
 
 if not os.path.exists("img"): os.makedirs("img")
@@ -26,6 +83,152 @@ BASE_URL = "http://127.0.0.1:8000/static"
 # Se a loja não responder em 25 segundos, ela é cortada para não travar o site
 TIMEOUT_GLOBAL = 25000 
 
+# --- CONFIGURAÇÃO DO POOL DE NAVEGADORES ---
+# Quantos Chromium ficam abertos e quantas abas cada um empresta ao mesmo tempo
+NAVEGADORES = int(os.environ.get("PRECIN_NAVEGADORES", 1))
+PAGINAS_POR_NAVEGADOR = int(os.environ.get("PRECIN_PAGINAS_POR_NAVEGADOR", 6))
+# Reciclagem: aba é recriada depois de N usos, navegador é relançado depois de M
+MAX_USOS_PAGINA = int(os.environ.get("PRECIN_MAX_USOS_PAGINA", 50))
+MAX_USOS_NAVEGADOR = int(os.environ.get("PRECIN_MAX_USOS_NAVEGADOR", 500))
+
+# Sem --single-process/--no-zygote: no navegador do pool uma aba que derruba o renderer levaria junto
+# todas as outras em uso. Hosts muito apertados de memória podem religá-las por PRECIN_CHROMIUM_EXTRA.
+ARGS_CHROMIUM = ['--no-sandbox', '--disable-setuid-sandbox', '--disable-dev-shm-usage', '--disable-gpu', '--disable-extensions'] \
+    + os.environ.get("PRECIN_CHROMIUM_EXTRA", "").split()
+USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"
+
+# --- FILTROS E PAGINAÇÃO ---
+# Marcas reconhecidas no título para a faceta de marca e o agrupamento
+MARCAS_COMUNS = ['Samsung', 'Apple', 'LG', 'Dell', 'Acer', 'Asus', 'Lenovo', 'HP', 'Kingston', 'Sandisk', 'Corsair', 'HyperX', 'Logitech', 'Razer', 'Redragon', 'JBL', 'Sony', 'Microsoft', 'Nintendo', 'PlayStation', 'Xbox', 'Intel', 'AMD', 'Nvidia', 'Gigabyte', 'MSI', 'Adata', 'Western Digital', 'Seagate', 'Motorola', 'Xiaomi', 'Philco', 'Mondial', 'Arno',
+                 'Zotac', 'Galax', 'PNY', 'Palit', 'Inno3D', 'Gainward', 'Colorful', 'PowerColor', 'Sapphire', 'XFX', 'ASRock', 'EVGA', 'Crucial']
+LIMITE_PAGINA = 24
+LIMITE_PAGINA_MAX = 100
+# Quantos conjuntos de resultado (consulta + lojas) guardam facetas e ordenações prontas
+MAX_INDICES = 200
+
+# --- AGRUPAMENTO DE OFERTAS IGUAIS ---
+# Fabricante do chip não identifica o produto (uma RTX da Asus e uma da MSI são produtos diferentes)
+MARCAS_CHIP = {'Nvidia', 'AMD', 'Intel'}
+# Palavras que mudam de loja para loja sem mudar o produto
+PALAVRAS_VAZIAS = {'placa', 'de', 'da', 'do', 'com', 'para', 'e', 'video', 'geforce', 'radeon', 'rtx', 'gtx', 'rx',
+                   'gddr5', 'gddr6', 'gddr6x', 'gddr7', 'dlss', 'ray', 'tracing', 'bits', 'bit', 'novo', 'original', 'lacrado',
+                   'ssd', 'm2', 'nvme', 'pcie', 'gen3', 'gen4', 'interno', 'leitura', 'gravacao', 'escrita', 'ate',
+                   'memoria', 'ram', 'desktop', 'smartphone', 'celular', 'tela', 'camera', 'mhz', 'hz'}
+# Variantes que separam produtos mesmo com o resto do título igual
+VARIANTES = {'ti', 'super', 'xt', 'xtx', 'oc', 'pro', 'max', 'plus', 'ultra', 'mini', 'lite'}
+# Semelhança mínima (Jaccard ponderado por IDF) entre as palavras de linha de duas ofertas do mesmo bloco
+AGRUPAR_LIMIAR = float(os.environ.get("PRECIN_AGRUPAR_LIMIAR", 0.6))
+# Blocos até este tamanho comparam todos os pares; acima, só pares que dividem alguma palavra não tão comum
+BLOCO_PEQUENO = 32
+
+# --- CONTROLE DE ADMISSÃO ---
+# Quantas buscas raspam ao mesmo tempo, quantas podem esperar na fila e por quanto tempo (s)
+BUSCAS_SIMULTANEAS = int(os.environ.get("PRECIN_BUSCAS_SIMULTANEAS", 4))
+FILA_MAX = int(os.environ.get("PRECIN_FILA_MAX", 16))
+ESPERA_MAX = float(os.environ.get("PRECIN_ESPERA_MAX", 5))
+
+# --- AQUECIMENTO EM SEGUNDO PLANO ---
+# Quantas consultas mais buscadas por loja são renovadas antes de vencer (0 desliga)
+AQUECER_TOP = int(os.environ.get("PRECIN_AQUECER_TOP", 20))
+# Popularidade mínima para entrar no aquecimento: cada busca vale 1 e cai pela metade a cada
+# AQUECER_MEIA_VIDA s (1.5 = pelo menos duas buscas recentes)
+AQUECER_MIN_BUSCAS = float(os.environ.get("PRECIN_AQUECER_MIN_BUSCAS", 1.5))
+AQUECER_MEIA_VIDA = float(os.environ.get("PRECIN_AQUECER_MEIA_VIDA", 3600))
+# Renova quando falta menos que isso (s) para o resultado expirar
+AQUECER_ANTECEDENCIA = float(os.environ.get("PRECIN_AQUECER_ANTECEDENCIA", 60))
+# Orçamento próprio: raspagens de aquecimento simultâneas e intervalo mínimo (s) entre duas na mesma loja
+AQUECER_SIMULTANEAS = int(os.environ.get("PRECIN_AQUECER_SIMULTANEAS", 2))
+AQUECER_INTERVALO_LOJA = float(os.environ.get("PRECIN_AQUECER_INTERVALO_LOJA", 3))
+# Pausa quando as buscas dos usuários ocupam esta fração das vagas de admissão
+AQUECER_PAUSA = float(os.environ.get("PRECIN_AQUECER_PAUSA", 0.75))
+AQUECER_CICLO = float(os.environ.get("PRECIN_AQUECER_CICLO", 10))
+AQUECER_MAX_CONSULTAS = 5000
+
+# --- BUSCA EM LOTE ---
+# Raspagens simultâneas de um lote na mesma loja e consultas do lote em andamento ao mesmo tempo
+LOTE_POR_LOJA = int(os.environ.get("PRECIN_LOTE_POR_LOJA", 2))
+LOTE_SIMULTANEAS = int(os.environ.get("PRECIN_LOTE_SIMULTANEAS", 8))
+# Onde POST /api/buscar/lote grava os trabalhos com nome (<pasta>/<trabalho>.jsonl)
+PASTA_LOTES = os.environ.get("PRECIN_PASTA_LOTES", "lotes")
+
+# --- CAMINHO DE DOWNLOAD POR LOJA ---
+# "http": só o cliente HTTP; "navegador": só Playwright;
+# "auto": tenta HTTP e cai pro navegador se vier bloqueio ou página sem produtos
+MODOS_BUSCA = {"ml": "auto", "amazon": "navegador", "kabum": "auto", "magalu": "auto", "pichau": "navegador", "terabyte": "navegador"}
+# Sobrescreve pelo ambiente, ex.: PRECIN_MODOS="amazon=auto,pichau=http"
+for _par in filter(None, os.environ.get("PRECIN_MODOS", "").split(",")):
+    _loja, _modo = _par.split("=")
+    MODOS_BUSCA[_loja.strip()] = _modo.strip()
+
+# Timeout (segundos) do caminho HTTP: curto, porque no "auto" ainda sobra o navegador
+TIMEOUT_HTTP = float(os.environ.get("PRECIN_TIMEOUT_HTTP", 8))
+HTTP_CONEXOES_POR_HOST = int(os.environ.get("PRECIN_HTTP_CONEXOES_POR_HOST", 6))
+
+# Endereço de cada loja; PRECIN_REPLAY_URL aponta todas para um servidor local (bench/replay.py)
+ORIGENS = {
+    "ml": "https://lista.mercadolivre.com.br",
+    "amazon": "https://www.amazon.com.br",
+    "kabum": "https://www.kabum.com.br",
+    "magalu": "https://www.magazineluiza.com.br",
+    "pichau": "https://www.pichau.com.br",
+    "terabyte": "https://www.terabyteshop.com.br",
+}
+if os.environ.get("PRECIN_REPLAY_URL"):
+    ORIGENS = {loja: f"{os.environ['PRECIN_REPLAY_URL'].rstrip('/')}/{loja}" for loja in ORIGENS}
+
+# Textos que denunciam checagem de robô em vez da página de busca
+SINAIS_BLOQUEIO = {"amazon": ["captcha"]}
+SINAIS_BLOQUEIO_GERAIS = ["<title>just a moment...</title>", "cf-chl-bypass"]
+
+# --- PARSE DO HTML ---
+# "lxml" é bem mais rápido que o "html.parser" puro; usa o que estiver instalado
+try:
+    import lxml  # noqa: F401
+    PARSER_HTML = os.environ.get("PRECIN_PARSER", "lxml")
+except ImportError:
+    PARSER_HTML = os.environ.get("PRECIN_PARSER", "html.parser")
+# Onde o parse roda: "processo" (não disputa o GIL com a API), "thread" ou "loop" (no próprio event loop)
+EXECUTOR_PARSE = os.environ.get("PRECIN_PARSE_EXECUTOR", "processo")
+WORKERS_PARSE = int(os.environ.get("PRECIN_PARSE_WORKERS", min(4, os.cpu_count() or 1)))
+# Monta a árvore só com os contêineres de produto (SoupStrainer) em vez da página inteira
+USAR_FILTRO_PARSE = os.environ.get("PRECIN_PARSE_FILTRO", "1") == "1"
+
+def _com_classe(*classes):
+    # Durante o parse o SoupStrainer vê o atributo class inteiro ("a b c"), não a lista
+    return re.compile(r'(^|\s)(' + '|'.join(map(re.escape, classes)) + r')(\s|$)')
+
+FILTROS_PARSE = {
+    "ml": SoupStrainer(class_=_com_classe('ui-search-layout__item', 'ui-search-result__wrapper', 'poly-card')),
+    "amazon": SoupStrainer('div', attrs={'data-component-type': 's-search-result'}),
+    "kabum": SoupStrainer(class_=_com_classe('productCard')),
+    "magalu": SoupStrainer(attrs={'data-testid': 'product-card-container'}),
+    "pichau": SoupStrainer(class_=_com_classe('MuiGrid-item')),
+}
+
+# --- PRAZO DA BUSCA E DISJUNTORES ---
+# Prazo total (segundos) de uma busca: depois disso responde com o que chegou
+PRAZO_BUSCA = float(os.environ.get("PRECIN_PRAZO_BUSCA", 20))
+# Depois de N falhas seguidas (timeout, erro, captcha) a loja fica de fora por X segundos
+DISJUNTOR_LIMITE_FALHAS = int(os.environ.get("PRECIN_DISJUNTOR_FALHAS", 3))
+DISJUNTOR_RESFRIAMENTO = float(os.environ.get("PRECIN_DISJUNTOR_RESFRIAMENTO", 120))
+
+# --- CONFIGURAÇÃO DO CACHE ---
+# Tempo (segundos) que o resultado de uma loja é considerado fresco
+TTL_POR_LOJA = {"ml": 300, "amazon": 600, "kabum": 300, "magalu": 600, "pichau": 300, "terabyte": 600}
+TTL_PADRAO = 300
+# Lista vazia dura pouco para não esconder a loja (erros nunca entram no cache)
+TTL_VAZIO = 30
+# Depois de expirar, o resultado ainda é servido por este tempo enquanto atualiza em segundo plano
+JANELA_STALE = int(os.environ.get("PRECIN_CACHE_JANELA_STALE", 1800))
+CACHE_MAX_ITENS = int(os.environ.get("PRECIN_CACHE_MAX_ITENS", 1000))
+
+# --- HISTÓRICO DE OFERTAS ---
+# Banco SQLite com as ofertas raspadas e o histórico de preço ("" desliga)
+BANCO_OFERTAS = os.environ.get("PRECIN_BANCO", "precin.db")
+# Gravação em lote fora da requisição: a cada N raspagens ou a cada X segundos
+GRAVACAO_LOTE = int(os.environ.get("PRECIN_GRAVACAO_LOTE", 50))
+GRAVACAO_INTERVALO = float(os.environ.get("PRECIN_GRAVACAO_INTERVALO", 2))
+
 def limpar_preco(texto):
     if not texto: return None
     texto_limpo = texto.replace('R$', '').replace('.', '').replace(',', '.').replace('\xa0', '').strip()
@@ -33,321 +236,1883 @@ def limpar_preco(texto):
     if match: return float(match.group(1))
     return None
 
+class LojaBloqueada(Exception):
+    """A loja respondeu com captcha/checagem de robô em vez da busca."""
+
+class LojaSobrecarregada(Exception):
+    """A loja respondeu 429/503: fora do ar ou limitando as requisições, não pedindo captcha."""
+
+class LojaIndisponivel(Exception):
+    """O disjuntor da loja está aberto; nem tentamos raspar."""
+
+def classificar_erro(e):
+    if isinstance(e, (PlaywrightTimeout, asyncio.TimeoutError, httpx.TimeoutException)): return "timeout"
+    if isinstance(e, LojaBloqueada): return "captcha"
+    if isinstance(e, LojaSobrecarregada): return "sobrecarga"
+    if isinstance(e, LojaIndisponivel): return "disjuntor"
+    return "erro"
+
 async def bloquear_recursos(route):
     if route.request.resource_type in ["image", "media", "font", "stylesheet", "script", "other"]:
         await route.abort()
     else:
         await route.continue_()
 
+# --- MEDIÇÃO DAS ETAPAS ---
+
+# Funções (loja, etapa, segundos) chamadas ao fim de cada etapa: lancar, aba, http, goto, content, parse
+observadores_etapas = []
+
+@contextmanager
+def medir_etapa(loja, etapa):
+    inicio = time.perf_counter()
+    try:
+        yield
+    finally:
+        duracao = time.perf_counter() - inicio
+        for observador in observadores_etapas: observador(loja, etapa, duracao)
+
+# --- MÉTRICAS (formato Prometheus em /metrics) ---
+
+def _escapar(valor):
+    return str(valor).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _rotulos(nomes, valores, extra=None):
+    pares = [f'{nome}="{_escapar(valor)}"' for nome, valor in zip(nomes, valores)]
+    if extra: pares.append(extra)
+    return "{" + ",".join(pares) + "}" if pares else ""
+
+class Contador:
+    def __init__(self, nome, ajuda, rotulos=()):
+        self.nome, self.ajuda, self.rotulos = nome, ajuda, tuple(rotulos)
+        self.valores = {}
+
+    def inc(self, *rotulos, valor=1):
+        self.valores[rotulos] = self.valores.get(rotulos, 0) + valor
+
+    def exportar(self):
+        linhas = [f"# HELP {self.nome} {self.ajuda}", f"# TYPE {self.nome} counter"]
+        for rotulos, valor in sorted(self.valores.items()):
+            linhas.append(f"{self.nome}{_rotulos(self.rotulos, rotulos)} {valor}")
+        return linhas
+
+class Medidor:
+    """Valor lido na hora da exportação: `ler()` devolve {rotulos: valor}."""
+
+    def __init__(self, nome, ajuda, rotulos, ler, tipo="gauge"):
+        self.nome, self.ajuda, self.rotulos, self.ler, self.tipo = nome, ajuda, tuple(rotulos), ler, tipo
+
+    def exportar(self):
+        linhas = [f"# HELP {self.nome} {self.ajuda}", f"# TYPE {self.nome} {self.tipo}"]
+        for rotulos, valor in sorted(self.ler().items()):
+            linhas.append(f"{self.nome}{_rotulos(self.rotulos, rotulos)} {valor}")
+        return linhas
+
+class Histograma:
+    BALDES = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30)
+
+    def __init__(self, nome, ajuda, rotulos=(), baldes=BALDES):
+        self.nome, self.ajuda, self.rotulos, self.baldes = nome, ajuda, tuple(rotulos), baldes
+        self.series = {}
+
+    def observar(self, valor, *rotulos):
+        serie = self.series.get(rotulos)
+        if serie is None:
+            serie = self.series[rotulos] = {"baldes": [0] * len(self.baldes), "soma": 0.0, "n": 0}
+        for i, limite in enumerate(self.baldes):
+            if valor <= limite: serie["baldes"][i] += 1
+        serie["soma"] += valor
+        serie["n"] += 1
+
+    def exportar(self):
+        linhas = [f"# HELP {self.nome} {self.ajuda}", f"# TYPE {self.nome} histogram"]
+        for rotulos, serie in sorted(self.series.items()):
+            for limite, n in zip(self.baldes + ("+Inf",), serie["baldes"] + [serie["n"]]):
+                le = 'le="%s"' % limite
+                linhas.append(f"{self.nome}_bucket{_rotulos(self.rotulos, rotulos, le)} {n}")
+            linhas.append(f"{self.nome}_sum{_rotulos(self.rotulos, rotulos)} {serie['soma']}")
+            linhas.append(f"{self.nome}_count{_rotulos(self.rotulos, rotulos)} {serie['n']}")
+        return linhas
+
+metricas = []
+
+def registrar_metrica(metrica):
+    metricas.append(metrica)
+    return metrica
+
+def exportar_metricas():
+    return "\n".join(linha for metrica in metricas for linha in metrica.exportar()) + "\n"
+
+METRICA_ETAPA = registrar_metrica(Histograma("precin_etapa_segundos", "Duração de cada etapa da raspagem (aba, http, goto, content, parse, lancar)", ("loja", "etapa")))
+METRICA_LOJA = registrar_metrica(Histograma("precin_loja_segundos", "Duração da raspagem completa de uma loja", ("loja",)))
+METRICA_RASPAGENS = registrar_metrica(Contador("precin_raspagens_total", "Raspagens por resultado (ok, sem_itens, timeout, captcha, erro, disjuntor)", ("loja", "resultado")))
+METRICA_ITENS = registrar_metrica(Contador("precin_itens_total", "Ofertas extraídas", ("loja",)))
+METRICA_CACHE = registrar_metrica(Contador("precin_cache_total", "Consultas ao cache por resultado (fresco, stale, compartilhado, miss)", ("loja", "resultado")))
+METRICA_BUSCA = registrar_metrica(Histograma("precin_busca_segundos", "Duração de uma busca de ponta a ponta", ("endpoint",)))
+
+# Contexto da requisição com debug=1: junta as etapas de cada loja para devolver na resposta
+_coleta_debug = contextvars.ContextVar("coleta_debug", default=None)
+
+def _observar_etapa(loja, etapa, segundos):
+    METRICA_ETAPA.observar(segundos, loja, etapa)
+    coleta = _coleta_debug.get()
+    if coleta is not None:
+        etapas = coleta.setdefault(loja, {}).setdefault("etapas_ms", {})
+        etapas[etapa] = round(etapas.get(etapa, 0) + segundos * 1000, 2)
+
+observadores_etapas.append(_observar_etapa)
+
+# --- POOL DE NAVEGADORES ---
+
+class _Navegador:
+    """Um Chromium com um único contexto, relançado quando cai ou atinge MAX_USOS_NAVEGADOR."""
+
+    def __init__(self):
+        self.browser = None
+        self.context = None
+        self.geracao = 0
+        self.usos = 0
+        self.emprestadas = 0
+        self.reciclar = False
+        self.lock = asyncio.Lock()
+
+    def saudavel(self):
+        return self.browser is not None and self.browser.is_connected() and not self.reciclar
+
+class PoolNavegadores:
+    """Navegadores e abas reaproveitados entre buscas.
+
+    Cada vaga do pool é uma aba (já com `bloquear_recursos` instalado) presa a
+    um navegador. Quem pede uma aba espera na fila enquanto todas estão em uso.
+    """
+
+    def __init__(self, navegadores=NAVEGADORES, paginas_por_navegador=PAGINAS_POR_NAVEGADOR,
+                 max_usos_pagina=MAX_USOS_PAGINA, max_usos_navegador=MAX_USOS_NAVEGADOR):
+        self.total_navegadores = navegadores
+        self.paginas_por_navegador = paginas_por_navegador
+        self.max_usos_pagina = max_usos_pagina
+        self.max_usos_navegador = max_usos_navegador
+        self._playwright = None
+        self._navegadores = []
+        self._livres = None
+        self._lock = asyncio.Lock()
+
+    @property
+    def iniciado(self):
+        return self._playwright is not None
+
+    async def iniciar(self):
+        async with self._lock:
+            if self.iniciado: return
+            self._playwright = await async_playwright().start()
+            self._livres = asyncio.Queue()
+            self._navegadores = [_Navegador() for _ in range(self.total_navegadores)]
+            for nav in self._navegadores:
+                await self._lancar(nav)
+                for _ in range(self.paginas_por_navegador):
+                    self._livres.put_nowait({"nav": nav, "pagina": None, "geracao": nav.geracao, "usos": 0})
+            print(f"🌐 POOL: {self.total_navegadores} navegador(es) x {self.paginas_por_navegador} abas prontos")
+
+    async def fechar(self):
+        async with self._lock:
+            if not self.iniciado: return
+            for nav in self._navegadores:
+                await self._encerrar(nav)
+            await self._playwright.stop()
+            self._playwright = None
+            self._navegadores = []
+
+    async def _lancar(self, nav):
+        with medir_etapa("pool", "lancar"):
+            nav.browser = await self._playwright.chromium.launch(headless=True, args=ARGS_CHROMIUM)
+            nav.context = await nav.browser.new_context(viewport={'width': 800, 'height': 600}, user_agent=USER_AGENT)
+        nav.geracao += 1
+        nav.usos = 0
+        nav.reciclar = False
+
+    async def _encerrar(self, nav):
+        try:
+            if nav.browser: await nav.browser.close()
+        except Exception: pass
+        nav.browser = None
+        nav.context = None
+
+    async def _relancar(self, nav):
+        async with nav.lock:
+            if nav.saudavel(): return
+            motivo = "reciclagem" if nav.reciclar else "queda"
+            print(f"♻️ POOL: relançando navegador ({motivo})")
+            await self._encerrar(nav)
+            await self._lancar(nav)
+
+    async def _preparar(self, vaga):
+        nav = vaga["nav"]
+        # Navegador caído é relançado na hora; reciclagem espera as abas emprestadas voltarem
+        if nav.browser is None or not nav.browser.is_connected() or (nav.reciclar and nav.emprestadas == 0):
+            await self._relancar(nav)
+        pagina = vaga["pagina"]
+        if pagina is None or pagina.is_closed() or vaga["geracao"] != nav.geracao:
+            pagina = await nav.context.new_page()
+            await pagina.route("**/*", bloquear_recursos)
+            vaga.update(pagina=pagina, geracao=nav.geracao, usos=0)
+        nav.emprestadas += 1
+        return pagina
+
+    async def _devolver(self, vaga, ok):
+        nav = vaga["nav"]
+        nav.emprestadas -= 1
+        nav.usos += 1
+        vaga["usos"] += 1
+        if nav.usos >= self.max_usos_navegador: nav.reciclar = True
+        # Aba que deu erro ou já foi muito usada é descartada; a próxima vem limpa
+        if not ok or vaga["usos"] >= self.max_usos_pagina:
+            try:
+                if vaga["pagina"] and not vaga["pagina"].is_closed(): await vaga["pagina"].close()
+            except Exception: pass
+            vaga["pagina"] = None
+        self._livres.put_nowait(vaga)
+
+    @asynccontextmanager
+    async def pagina(self, loja="pool"):
+        if not self.iniciado: await self.iniciar()
+        with medir_etapa(loja, "aba"):
+            vaga = await self._livres.get()
+            try:
+                pagina = await self._preparar(vaga)
+            except BaseException:
+                vaga["pagina"] = None
+                self._livres.put_nowait(vaga)
+                raise
+        ok = False
+        try:
+            yield pagina
+            ok = True
+        finally:
+            await self._devolver(vaga, ok)
+
+pool = PoolNavegadores()
+
+# --- CACHE DE RESULTADOS ---
+
+def normalizar_consulta(texto):
+    texto = unicodedata.normalize('NFKD', texto).encode('ascii', 'ignore').decode()
+    return " ".join(texto.lower().split())
+
+class CacheResultados:
+    """Cache LRU por (consulta normalizada, loja).
+
+    Entradas expiradas ainda são servidas dentro de JANELA_STALE enquanto uma
+    raspagem em segundo plano as atualiza, e buscas idênticas simultâneas
+    compartilham a mesma raspagem (single-flight).
+    """
+
+    def __init__(self, max_itens=CACHE_MAX_ITENS, ttl_por_loja=TTL_POR_LOJA, janela_stale=JANELA_STALE):
+        self.max_itens = max_itens
+        self.ttl_por_loja = ttl_por_loja
+        self.janela_stale = janela_stale
+        self._itens = OrderedDict()
+        self._em_voo = {}
+
+    def _ttl(self, loja, valor):
+        if not valor: return TTL_VAZIO
+        return self.ttl_por_loja.get(loja, TTL_PADRAO)
+
+    def _guardar(self, chave, valor):
+        # Resultado vindo do banco já tem idade: expira quando expiraria a raspagem original
+        expira = time.monotonic() + self._ttl(chave[1], valor) - getattr(valor, "idade", 0)
+        self._itens[chave] = {"valor": valor, "expira": expira}
+        self._itens.move_to_end(chave)
+        while len(self._itens) > self.max_itens:
+            self._itens.popitem(last=False)
+
+    async def _executar(self, chave, carregar):
+        valor = await carregar()
+        self._guardar(chave, valor)
+        return valor
+
+    def _disparar(self, chave, carregar):
+        task = self._em_voo.get(chave)
+        if task is None:
+            task = asyncio.create_task(self._executar(chave, carregar))
+            self._em_voo[chave] = task
+            task.add_done_callback(lambda t: self._encerrar(chave, t))
+        return task
+
+    def _encerrar(self, chave, task):
+        self._em_voo.pop(chave, None)
+        # Quem esperava pode ter desistido pelo prazo: o erro já foi contado em executar_loja e
+        # é lido aqui para o asyncio não reclamar de "Task exception was never retrieved"
+        if not task.cancelled(): task.exception()
+
+    def _revalidar(self, chave, carregar):
+        if chave in self._em_voo: return
+        # Ninguém espera por esta task: o erro é só registrado
+        self._disparar(chave, carregar).add_done_callback(self._registrar_falha)
+
+    @staticmethod
+    def _registrar_falha(task):
+        if not task.cancelled() and task.exception() and not isinstance(task.exception(), LojaIndisponivel):
+            print(f"   ❌ CACHE: falha ao atualizar em segundo plano: {task.exception()!r}")
+
+    async def obter(self, loja, produto, carregar):
+        chave = (normalizar_consulta(produto), loja)
+        item = self._itens.get(chave)
+        if item:
+            self._itens.move_to_end(chave)
+            agora = time.monotonic()
+            if agora < item["expira"]:
+                METRICA_CACHE.inc(loja, "fresco")
+                return item["valor"]
+            if agora < item["expira"] + self.janela_stale:
+                METRICA_CACHE.inc(loja, "stale")
+                self._revalidar(chave, carregar)
+                return item["valor"]
+        METRICA_CACHE.inc(loja, "compartilhado" if chave in self._em_voo else "miss")
+        # shield: se quem pediu desistir, a raspagem continua e abastece o cache para os outros
+        return await asyncio.shield(self._disparar(chave, carregar))
+
+    def restante(self, loja, produto):
+        """Segundos até o resultado expirar (negativo se já expirou), None se não está no cache."""
+        item = self._itens.get((normalizar_consulta(produto), loja))
+        return None if item is None else item["expira"] - time.monotonic()
+
+    def em_voo(self, loja, produto):
+        return (normalizar_consulta(produto), loja) in self._em_voo
+
+    async def atualizar(self, loja, produto, carregar):
+        """Raspa de novo agora e guarda, compartilhando a raspagem se já houver uma em voo."""
+        return await self._disparar((normalizar_consulta(produto), loja), carregar)
+
+    def disponivel(self, loja, produto):
+        """True se há resultado servível (fresco ou dentro da janela stale) sem raspar agora."""
+        item = self._itens.get((normalizar_consulta(produto), loja))
+        return item is not None and time.monotonic() < item["expira"] + self.janela_stale
+
+    def limpar(self):
+        self._itens.clear()
+
+cache = CacheResultados()
+
+# --- DISJUNTORES POR LOJA ---
+
+class Disjuntor:
+    """Circuit breaker simples: abre depois de `limite_falhas` falhas seguidas.
+
+    Passado o resfriamento, deixa uma única tentativa passar; se ela falhar o
+    disjuntor reabre, se der certo volta ao normal.
+    """
+
+    def __init__(self, loja, limite_falhas=DISJUNTOR_LIMITE_FALHAS, resfriamento=DISJUNTOR_RESFRIAMENTO):
+        self.loja = loja
+        self.limite_falhas = limite_falhas
+        self.resfriamento = resfriamento
+        self.falhas = 0
+        self.aberto_ate = 0.0
+        self.ultima_falha = None
+
+    @property
+    def aberto(self):
+        return self.falhas >= self.limite_falhas and time.monotonic() < self.aberto_ate
+
+    def permitir(self):
+        if self.falhas < self.limite_falhas: return True
+        agora = time.monotonic()
+        if agora < self.aberto_ate: return False
+        # Meio-aberto: reserva a vaga de teste empurrando o prazo de novo
+        self.aberto_ate = agora + self.resfriamento
+        return True
+
+    def sucesso(self):
+        self.falhas = 0
+        self.aberto_ate = 0.0
+
+    def falha(self, tipo):
+        self.falhas += 1
+        self.ultima_falha = tipo
+        if self.falhas >= self.limite_falhas:
+            self.aberto_ate = time.monotonic() + self.resfriamento
+            print(f"   🔌 {self.loja}: disjuntor aberto por {self.resfriamento:.0f}s ({self.falhas} falhas, última: {tipo})")
+
+# --- HISTÓRICO DE OFERTAS (SQLite) ---
+
+ESQUEMA_OFERTAS = """
+CREATE TABLE IF NOT EXISTS ofertas (
+    link TEXT NOT NULL,
+    loja TEXT NOT NULL,
+    loja_nome TEXT,
+    nome TEXT,
+    titulo_norm TEXT,
+    img TEXT,
+    preco REAL,
+    preco_anterior REAL,
+    visto_em REAL,
+    PRIMARY KEY (link, loja)
+);
+CREATE INDEX IF NOT EXISTS idx_ofertas_loja ON ofertas (loja, visto_em);
+CREATE INDEX IF NOT EXISTS idx_ofertas_titulo ON ofertas (titulo_norm);
+CREATE INDEX IF NOT EXISTS idx_ofertas_visto ON ofertas (visto_em);
+CREATE TABLE IF NOT EXISTS precos (
+    link TEXT NOT NULL,
+    loja TEXT NOT NULL,
+    preco REAL,
+    visto_em REAL
+);
+CREATE INDEX IF NOT EXISTS idx_precos_link ON precos (link, visto_em);
+CREATE INDEX IF NOT EXISTS idx_precos_visto ON precos (visto_em);
+CREATE TABLE IF NOT EXISTS buscas (
+    consulta TEXT NOT NULL,
+    loja TEXT NOT NULL,
+    links TEXT,
+    visto_em REAL,
+    PRIMARY KEY (consulta, loja)
+);
+"""
+
+class OfertasGuardadas(list):
+    """Lista de ofertas lida do banco; `idade` é há quantos segundos foi raspada."""
+    idade = 0
+
+class ArmazemOfertas:
+    """Ofertas raspadas em SQLite, com histórico de preço.
+
+    Toda conversa com o banco roda numa thread própria. As gravações ficam
+    numa fila e vão em lote a cada GRAVACAO_INTERVALO segundos (ou quando
+    juntam GRAVACAO_LOTE raspagens), fora do caminho da requisição. Em
+    `precos` só entra uma linha quando o preço muda; a `ofertas` guarda o
+    preço atual e o anterior, que vira o `preco_antigo` da resposta.
+    """
+
+    def __init__(self, caminho=BANCO_OFERTAS, lote=GRAVACAO_LOTE, intervalo=GRAVACAO_INTERVALO):
+        self.caminho = caminho
+        self.lote = lote
+        self.intervalo = intervalo
+        self._conexao = None
+        self._executor = None
+        self._pendentes = []
+        self._acordar = None
+        self._tarefa = None
+
+    @property
+    def ativo(self):
+        return self._conexao is not None
+
+    async def abrir(self):
+        if not self.caminho or self.ativo: return
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="precin-banco")
+        self._conexao = await self._rodar(self._conectar)
+        self._acordar = asyncio.Event()
+        self._tarefa = asyncio.create_task(self._laco())
+        print(f"🗄️ BANCO DE OFERTAS: {self.caminho}")
+
+    def _conectar(self):
+        conexao = sqlite3.connect(self.caminho, check_same_thread=False)
+        conexao.execute("PRAGMA journal_mode=WAL")
+        conexao.execute("PRAGMA synchronous=NORMAL")
+        conexao.executescript(ESQUEMA_OFERTAS)
+        return conexao
+
+    async def fechar(self):
+        if not self.ativo: return
+        self._tarefa.cancel()
+        await self.descarregar()
+        await self._rodar(self._conexao.close)
+        self._executor.shutdown()
+        self._conexao = None
+
+    async def _rodar(self, funcao, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, funcao, *args)
+
+    # --- gravação ---
+
+    def registrar(self, loja, produto, resultados):
+        """Põe uma raspagem na fila de gravação; não bloqueia."""
+        if not self.ativo or not resultados: return
+        self._pendentes.append((loja, normalizar_consulta(produto), resultados, time.time()))
+        if len(self._pendentes) >= self.lote: self._acordar.set()
+
+    async def _laco(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._acordar.wait(), self.intervalo)
+            except asyncio.TimeoutError:
+                pass
+            self._acordar.clear()
+            try:
+                await self.descarregar()
+            except Exception as e:
+                print(f"   ❌ BANCO: falha ao gravar lote: {e!r}")
+
+    async def descarregar(self):
+        if not self._pendentes: return
+        lote, self._pendentes = self._pendentes, []
+        with medir_etapa("banco", "gravar"):
+            await self._rodar(self._gravar, lote)
+
+    def _gravar(self, lote):
+        with self._conexao:
+            for loja, consulta, resultados, agora in lote:
+                for p in resultados:
+                    atual = self._conexao.execute("SELECT preco FROM ofertas WHERE link = ? AND loja = ?", (p['link'], loja)).fetchone()
+                    if atual is None or atual[0] != p['preco']:
+                        self._conexao.execute("INSERT INTO precos (link, loja, preco, visto_em) VALUES (?, ?, ?, ?)", (p['link'], loja, p['preco'], agora))
+                    self._conexao.execute("""
+                        INSERT INTO ofertas (link, loja, loja_nome, nome, titulo_norm, img, preco, preco_anterior, visto_em)
+                        VALUES (?, ?, ?, ?, ?, ?, ?, NULL, ?)
+                        ON CONFLICT (link, loja) DO UPDATE SET
+                            loja_nome = excluded.loja_nome, nome = excluded.nome, titulo_norm = excluded.titulo_norm, img = excluded.img,
+                            preco_anterior = CASE WHEN ofertas.preco != excluded.preco THEN ofertas.preco ELSE ofertas.preco_anterior END,
+                            preco = excluded.preco, visto_em = excluded.visto_em
+                    """, (p['link'], loja, p['loja'], p['nome'], normalizar_consulta(p['nome']), p['img'], p['preco'], agora))
+                self._conexao.execute("INSERT OR REPLACE INTO buscas (consulta, loja, links, visto_em) VALUES (?, ?, ?, ?)",
+                                      (consulta, loja, json.dumps([p['link'] for p in resultados]), agora))
+
+    # --- leitura ---
+
+    async def completar_preco_antigo(self, loja, resultados):
+        """Preenche `preco_antigo` com o último preço diferente visto, se era maior."""
+        if not self.ativo or not resultados: return
+        with medir_etapa(loja, "banco"):
+            guardados = await self._rodar(self._precos_guardados, loja, [p['link'] for p in resultados])
+        for p in resultados:
+            if p.get('preco_antigo') is not None or p['link'] not in guardados: continue
+            preco, preco_anterior = guardados[p['link']]
+            # Se o preço mudou desde a última raspagem, o guardado é o anterior
+            anterior = preco if preco != p['preco'] else preco_anterior
+            if anterior and anterior > p['preco']: p['preco_antigo'] = anterior
+
+    def _precos_guardados(self, loja, links):
+        guardados = {}
+        # Em fatias para não passar do limite de parâmetros do SQLite
+        for i in range(0, len(links), 500):
+            fatia = links[i:i + 500]
+            for link, preco, preco_anterior in self._conexao.execute(
+                    f"SELECT link, preco, preco_anterior FROM ofertas WHERE loja = ? AND link IN ({','.join('?' * len(fatia))})", (loja, *fatia)):
+                guardados[link] = (preco, preco_anterior)
+        return guardados
+
+    async def recentes(self, loja, produto, idade_max):
+        """Ofertas da última raspagem desta busca, se ela tiver menos de `idade_max` segundos."""
+        if not self.ativo: return None
+        return await self._rodar(self._recentes, loja, normalizar_consulta(produto), idade_max)
+
+    def _recentes(self, loja, consulta, idade_max):
+        linha = self._conexao.execute("SELECT links, visto_em FROM buscas WHERE consulta = ? AND loja = ?", (consulta, loja)).fetchone()
+        if linha is None or time.time() - linha[1] >= idade_max: return None
+        links = json.loads(linha[0])
+        ofertas = {}
+        for i in range(0, len(links), 500):
+            fatia = links[i:i + 500]
+            for link, loja_nome, nome, img, preco, preco_anterior in self._conexao.execute(
+                    f"SELECT link, loja_nome, nome, img, preco, preco_anterior FROM ofertas WHERE loja = ? AND link IN ({','.join('?' * len(fatia))})",
+                    (loja, *fatia)):
+                ofertas[link] = {"nome": nome, "loja": loja_nome, "preco": preco,
+                                 "preco_antigo": preco_anterior if preco_anterior and preco_anterior > preco else None,
+                                 "link": link, "img": img}
+        resultado = OfertasGuardadas(ofertas[link] for link in links if link in ofertas)
+        resultado.idade = time.time() - linha[1]
+        return resultado
+
+    async def historico(self, link, dias):
+        if not self.ativo: return None
+        return await self._rodar(self._historico, link, time.time() - dias * 86400)
+
+    def _historico(self, link, desde):
+        oferta = self._conexao.execute(
+            "SELECT loja, loja_nome, nome, img, preco, preco_anterior, visto_em FROM ofertas WHERE link = ? ORDER BY visto_em DESC LIMIT 1", (link,)).fetchone()
+        if oferta is None: return None
+        loja, loja_nome, nome, img, preco, preco_anterior, visto_em = oferta
+        precos = [{"preco": p, "visto_em": v} for p, v in self._conexao.execute(
+            "SELECT preco, visto_em FROM precos WHERE link = ? AND loja = ? AND visto_em >= ? ORDER BY visto_em", (link, loja, desde))]
+        valores = [p["preco"] for p in precos] or [preco]
+        return {"link": link, "loja": loja_nome, "nome": nome, "img": img, "preco": preco, "preco_anterior": preco_anterior,
+                "visto_em": visto_em, "minimo": min(valores), "maximo": max(valores), "precos": precos}
+
+armazem = ArmazemOfertas()
+
+# --- DOWNLOAD: HTTP COM POOL DE CONEXÕES, NAVEGADOR COMO RESERVA ---
+
+_cliente_http = None
+_semaforos_host = {}
+# Quantas vezes cada loja foi servida por cada caminho
+caminhos_usados = {loja: {"http": 0, "navegador": 0, "fallback": 0} for loja in MODOS_BUSCA}
+
+def usa_navegador():
+    return any(modo != "http" for modo in MODOS_BUSCA.values())
+
+def obter_cliente_http():
+    global _cliente_http
+    if _cliente_http is None:
+        # Compressão: o httpx já negocia gzip/deflate (e br/zstd se os pacotes estiverem instalados)
+        _cliente_http = httpx.AsyncClient(
+            http2=True,
+            follow_redirects=True,
+            timeout=TIMEOUT_HTTP,
+            limits=httpx.Limits(max_connections=HTTP_CONEXOES_POR_HOST * len(ORIGENS), max_keepalive_connections=HTTP_CONEXOES_POR_HOST * len(ORIGENS)),
+            headers={"User-Agent": USER_AGENT, "Accept": "text/html,application/xhtml+xml", "Accept-Language": "pt-BR,pt;q=0.9"},
+        )
+    return _cliente_http
+
+async def fechar_cliente_http():
+    global _cliente_http
+    if _cliente_http is not None:
+        await _cliente_http.aclose()
+        _cliente_http = None
+
+def parece_bloqueio(loja, content):
+    texto = content.lower()
+    return any(sinal in texto for sinal in SINAIS_BLOQUEIO.get(loja, []) + SINAIS_BLOQUEIO_GERAIS)
+
+async def baixar_http(loja, url):
+    host = urlsplit(url).netloc
+    if host not in _semaforos_host: _semaforos_host[host] = asyncio.Semaphore(HTTP_CONEXOES_POR_HOST)
+    async with _semaforos_host[host]:
+        with medir_etapa(loja, "http"):
+            resposta = await obter_cliente_http().get(url)
+    if resposta.status_code in (429, 503): raise LojaSobrecarregada(f"HTTP {resposta.status_code}")
+    if resposta.status_code == 403: raise LojaBloqueada("HTTP 403")
+    resposta.raise_for_status()
+    if parece_bloqueio(loja, resposta.text): raise LojaBloqueada("checagem de robô")
+    return resposta.text
+
+async def baixar_navegador(loja, pool, url, timeout):
+    async with pool.pagina(loja) as page:
+        with medir_etapa(loja, "goto"):
+            await page.goto(url, wait_until="domcontentloaded", timeout=timeout)
+        with medir_etapa(loja, "content"):
+            content = await page.content()
+    if parece_bloqueio(loja, content): raise LojaBloqueada("checagem de robô")
+    return content
+
+async def baixar_e_extrair(loja, pool, url, extrair, timeout=TIMEOUT_GLOBAL):
+    """Baixa a busca pelo caminho configurado em MODOS_BUSCA e devolve (resultados, caminho)."""
+    modo = MODOS_BUSCA.get(loja, "navegador")
+    if modo != "navegador":
+        try:
+            resultados = await extrair_fora_do_loop(extrair, await baixar_http(loja, url), loja)
+            if resultados or modo == "http":
+                caminhos_usados[loja]["http"] += 1
+                return resultados, "http"
+            motivo = "sem produtos"
+        except Exception as e:
+            if modo == "http": raise
+            motivo = f"{classificar_erro(e)}: {e!r:.80}"
+        print(f"   ↪️ {loja}: HTTP não serviu ({motivo}), indo pro navegador")
+
+    resultados = await extrair_fora_do_loop(extrair, await baixar_navegador(loja, pool, url, timeout), loja)
+    caminho = "fallback" if modo == "auto" else "navegador"
+    caminhos_usados[loja][caminho] += 1
+    return resultados, caminho
+
+# --- PARSE FORA DO EVENT LOOP ---
+
+_executor_parse = None
+
+def criar_soup(content, loja, filtrar=True):
+    filtro = FILTROS_PARSE.get(loja) if filtrar and USAR_FILTRO_PARSE else None
+    return BeautifulSoup(content, PARSER_HTML, parse_only=filtro)
+
+def selecionar_itens(content, loja, seletor):
+    """Monta a árvore só com os contêineres de produto; se o filtro não achar nada, tenta a página inteira."""
+    itens = seletor(criar_soup(content, loja))
+    if not itens and USAR_FILTRO_PARSE and loja in FILTROS_PARSE:
+        itens = seletor(criar_soup(content, loja, filtrar=False))
+    return itens
+
+def obter_executor_parse():
+    global _executor_parse
+    if _executor_parse is None:
+        if EXECUTOR_PARSE == "processo":
+            # spawn: não herda as threads do Playwright/httpx de um fork
+            _executor_parse = ProcessPoolExecutor(max_workers=WORKERS_PARSE, mp_context=multiprocessing.get_context("spawn"))
+        elif EXECUTOR_PARSE == "thread":
+            _executor_parse = ThreadPoolExecutor(max_workers=WORKERS_PARSE, thread_name_prefix="parse")
+    return _executor_parse
+
+def fechar_executor_parse():
+    global _executor_parse
+    if _executor_parse is not None:
+        _executor_parse.shutdown(wait=False, cancel_futures=True)
+        _executor_parse = None
+
+def _pid_do_worker(espera):
+    time.sleep(espera)
+    return os.getpid()
+
+async def aquecer_parse():
+    """Sobe todos os workers de parse antes da primeira busca.
+
+    O ProcessPoolExecutor só cria um processo por envio pendente e cada um
+    importa este módulo ao pegar o primeiro trabalho; tarefas curtas em
+    rodadas de WORKERS_PARSE até cada processo ter respondido uma.
+    """
+    executor = obter_executor_parse()
+    if not isinstance(executor, ProcessPoolExecutor): return
+    loop = asyncio.get_running_loop()
+    prontos = set()
+    limite = time.monotonic() + 30
+    while len(prontos) < WORKERS_PARSE and time.monotonic() < limite:
+        prontos.update(await asyncio.gather(*[loop.run_in_executor(executor, _pid_do_worker, 0.05) for _ in range(WORKERS_PARSE)]))
+
+async def extrair_fora_do_loop(extrair, content, loja="parse"):
+    executor = obter_executor_parse()
+    with medir_etapa(loja, "parse"):
+        if executor is None: return extrair(content)
+        return await asyncio.get_running_loop().run_in_executor(executor, extrair, content)
+
 # --- SCRAPERS OTIMIZADOS ---
 
-async def raspar_mercadolivre(context, produto):
+def montar_url(loja, produto):
+    termo_mais = produto.replace(' ', '+')
+    return {
+        "ml": f"{ORIGENS['ml']}/{produto.replace(' ', '-')}",
+        "amazon": f"{ORIGENS['amazon']}/s?k={termo_mais}",
+        "kabum": f"{ORIGENS['kabum']}/busca?query={termo_mais}",
+        "magalu": f"{ORIGENS['magalu']}/busca/{termo_mais}/",
+        "pichau": f"{ORIGENS['pichau']}/search?q={termo_mais}",
+        "terabyte": f"{ORIGENS['terabyte']}/busca?str={termo_mais}",
+    }[loja]
+
+def extrair_mercadolivre(content):
+    itens = selecionar_itens(content, "ml", lambda soup: soup.find_all('li', class_='ui-search-layout__item') or soup.find_all('div', class_='ui-search-result__wrapper') or soup.find_all('div', class_='poly-card'))
+    
+    resultados = []
+    for item in itens:
+        try:
+            titulo = item.find('h2', class_='ui-search-item__title') or item.find('a', class_='poly-component__title')
+            if not titulo: continue
+            
+            preco_tag = item.find('span', class_='andes-money-amount__fraction')
+            preco = limpar_preco(preco_tag.text) if preco_tag else None
+            
+            link_tag = item.find('a', class_='ui-search-link') or item.find('a', class_='poly-component__title') or item.find('a')
+            
+            img_src = f"{BASE_URL}/ml.png"
+            img_tag = item.find('img')
+            if img_tag: img_src = img_tag.get('data-src') or img_tag.get('src') or img_src
+
+            if preco: resultados.append({"nome": titulo.text.strip(), "loja": "Mercado Livre", "preco": preco, "preco_antigo": None, "link": link_tag['href'], "img": img_src})
+        except Exception: continue
+    return resultados
+
+async def raspar_mercadolivre(pool, produto):
     print("⏳ ML: Iniciando...")
     try:
-        page = await context.new_page()
-        await page.route("**/*", bloquear_recursos)
-        await page.goto(f"https://lista.mercadolivre.com.br/{produto.replace(' ', '-')}", wait_until="domcontentloaded", timeout=TIMEOUT_GLOBAL)
-        
-        content = await page.content()
-        await page.close()
-        
-        soup = BeautifulSoup(content, 'html.parser')
-        itens = soup.find_all('li', class_='ui-search-layout__item') or soup.find_all('div', class_='ui-search-result__wrapper') or soup.find_all('div', class_='poly-card')
-        
-        resultados = []
-        for item in itens:
-            try:
-                titulo = item.find('h2', class_='ui-search-item__title') or item.find('a', class_='poly-component__title')
-                if not titulo: continue
-                
-                preco_tag = item.find('span', class_='andes-money-amount__fraction')
-                preco = limpar_preco(preco_tag.text) if preco_tag else None
-                
-                link_tag = item.find('a', class_='ui-search-link') or item.find('a', class_='poly-component__title') or item.find('a')
-                
-                img_src = f"{BASE_URL}/ml.png"
-                img_tag = item.find('img')
-                if img_tag: img_src = img_tag.get('data-src') or img_tag.get('src') or img_src
-
-                if preco: resultados.append({"nome": titulo.text.strip(), "loja": "Mercado Livre", "preco": preco, "preco_antigo": None, "link": link_tag['href'], "img": img_src})
-            except: continue
-        print(f"   ✅ ML: {len(resultados)} ok")
+        resultados, caminho = await baixar_e_extrair("ml", pool, montar_url("ml", produto), extrair_mercadolivre)
+        print(f"   ✅ ML: {len(resultados)} ok ({caminho})")
         return resultados
-    except: 
-        print("   ❌ ML: Timeout ou Erro")
-        return []
+    except Exception as e: 
+        print(f"   ❌ ML: {classificar_erro(e)} ({e!r:.120})")
+        raise
+
+def extrair_amazon(content):
+    itens = selecionar_itens(content, "amazon", lambda soup: soup.find_all('div', {'data-component-type': 's-search-result'}))
+    
+    resultados = []
+    for item in itens:
+        try:
+            titulo_tag = item.find('span', class_='a-text-normal') or item.find('h2')
+            if not titulo_tag: continue
+            
+            preco_tag = item.find('span', class_='a-price-whole')
+            preco = limpar_preco(preco_tag.text) if preco_tag else None
+            if not preco:
+                preco_tag = item.find('span', class_='a-offscreen')
+                preco = limpar_preco(preco_tag.text) if preco_tag else None
+            
+            if not preco: continue
+
+            link_tag = item.find('a', class_='a-link-normal')
+            link = "https://www.amazon.com.br" + link_tag['href']
+            
+            img_src = f"{BASE_URL}/amazon.svg"
+            img_tag = item.find('img', class_='s-image')
+            if img_tag: img_src = img_tag.get('src') or img_src
+
+            resultados.append({"nome": titulo_tag.text.strip(), "loja": "Amazon", "preco": preco, "preco_antigo": None, "link": link, "img": img_src})
+        except Exception: continue
+    return resultados
 
-async def raspar_amazon(context, produto):
+async def raspar_amazon(pool, produto):
     print("⏳ Amazon: Iniciando...")
     try:
-        page = await context.new_page()
-        await page.route("**/*", bloquear_recursos)
-        await page.goto(f"https://www.amazon.com.br/s?k={produto.replace(' ', '+')}", wait_until="domcontentloaded", timeout=TIMEOUT_GLOBAL)
-        content = await page.content()
-        await page.close()
-
-        if "captcha" in content.lower(): return []
-
-        soup = BeautifulSoup(content, 'html.parser')
-        itens = soup.find_all('div', {'data-component-type': 's-search-result'})
-        
-        resultados = []
-        for item in itens:
-            try:
-                titulo_tag = item.find('span', class_='a-text-normal') or item.find('h2')
-                if not titulo_tag: continue
-                
-                preco_tag = item.find('span', class_='a-price-whole')
-                preco = limpar_preco(preco_tag.text) if preco_tag else None
-                if not preco:
-                    preco_tag = item.find('span', class_='a-offscreen')
-                    preco = limpar_preco(preco_tag.text) if preco_tag else None
-                
-                if not preco: continue
-
-                link_tag = item.find('a', class_='a-link-normal')
-                link = "https://www.amazon.com.br" + link_tag['href']
-                
-                img_src = f"{BASE_URL}/amazon.svg"
-                img_tag = item.find('img', class_='s-image')
-                if img_tag: img_src = img_tag.get('src') or img_src
-
-                resultados.append({"nome": titulo_tag.text.strip(), "loja": "Amazon", "preco": preco, "preco_antigo": None, "link": link, "img": img_src})
-            except: continue
-        print(f"   ✅ Amazon: {len(resultados)} ok")
+        resultados, caminho = await baixar_e_extrair("amazon", pool, montar_url("amazon", produto), extrair_amazon)
+        print(f"   ✅ Amazon: {len(resultados)} ok ({caminho})")
         return resultados
-    except: 
-        print("   ❌ Amazon: Timeout ou Erro")
-        return []
+    except Exception as e: 
+        print(f"   ❌ Amazon: {classificar_erro(e)} ({e!r:.120})")
+        raise
 
-async def raspar_kabum(context, produto):
+def extrair_kabum(content):
+    itens = selecionar_itens(content, "kabum", lambda soup: soup.find_all('article') or soup.find_all('div', class_='productCard'))
+    
+    resultados = []
+    for item in itens:
+        try:
+            titulo = item.find('span', class_='nameCard') or item.find('h2')
+            if not titulo: continue
+            
+            preco_tag = item.find('span', class_='priceCard')
+            preco = limpar_preco(preco_tag.text) if preco_tag else None
+            if not preco: continue
+
+            link_tag = item.find('a')
+            link = "https://www.kabum.com.br" + link_tag['href']
+            
+            img_src = f"{BASE_URL}/kabum.png"
+            img_tag = item.find('img')
+            if img_tag: img_src = img_tag.get('src') or img_src
+
+            resultados.append({"nome": titulo.text.strip(), "loja": "Kabum", "preco": preco, "preco_antigo": None, "link": link, "img": img_src})
+        except Exception: continue
+    return resultados
+
+async def raspar_kabum(pool, produto):
     print("⏳ Kabum: Iniciando...")
     try:
-        page = await context.new_page()
-        await page.route("**/*", bloquear_recursos)
-        await page.goto(f"https://www.kabum.com.br/busca?query={produto.replace(' ', '+')}", wait_until="domcontentloaded", timeout=TIMEOUT_GLOBAL)
-        content = await page.content()
-        await page.close()
-        
-        soup = BeautifulSoup(content, 'html.parser')
-        itens = soup.find_all('article') or soup.find_all('div', class_='productCard')
-        
-        resultados = []
-        for item in itens:
-            try:
-                titulo = item.find('span', class_='nameCard') or item.find('h2')
-                if not titulo: continue
-                
-                preco_tag = item.find('span', class_='priceCard')
-                preco = limpar_preco(preco_tag.text) if preco_tag else None
-                if not preco: continue
-
-                link_tag = item.find('a')
-                link = "https://www.kabum.com.br" + link_tag['href']
-                
-                img_src = f"{BASE_URL}/kabum.png"
-                img_tag = item.find('img')
-                if img_tag: img_src = img_tag.get('src') or img_src
-
-                resultados.append({"nome": titulo.text.strip(), "loja": "Kabum", "preco": preco, "preco_antigo": None, "link": link, "img": img_src})
-            except: continue
-        print(f"   ✅ Kabum: {len(resultados)} ok")
+        resultados, caminho = await baixar_e_extrair("kabum", pool, montar_url("kabum", produto), extrair_kabum)
+        print(f"   ✅ Kabum: {len(resultados)} ok ({caminho})")
         return resultados
-    except: 
-        print("   ❌ Kabum: Timeout ou Erro")
-        return []
+    except Exception as e: 
+        print(f"   ❌ Kabum: {classificar_erro(e)} ({e!r:.120})")
+        raise
+
+def extrair_magalu(content):
+    itens = selecionar_itens(content, "magalu", lambda soup: soup.find_all('li', {'data-testid': 'product-card-container'}) or soup.find_all('a', {'data-testid': 'product-card-container'}))
+    
+    resultados = []
+    for item in itens:
+        try:
+            titulo = item.find('h2', {'data-testid': 'product-title'})
+            if not titulo: continue
+            
+            preco_tag = item.find('p', {'data-testid': 'price-value'})
+            preco = limpar_preco(preco_tag.text) if preco_tag else None
+            
+            link = "https://www.magazineluiza.com.br" + (item['href'] if item.name == 'a' else item.find('a')['href'])
+            
+            img_src = f"{BASE_URL}/magalu.png"
+            img_tag = item.find('img', {'data-testid': 'product-image'}) or item.find('img')
+            if img_tag:
+                src = img_tag.get('src') or img_tag.get('data-src')
+                if src and "http" in src: img_src = src
+
+            if preco: resultados.append({"nome": titulo.text.strip(), "loja": "Magalu", "preco": preco, "preco_antigo": None, "link": link, "img": img_src})
+        except Exception: continue
+    return resultados
 
-async def raspar_magalu(context, produto):
+async def raspar_magalu(pool, produto):
     print("⏳ Magalu: Iniciando...")
     try:
-        page = await context.new_page()
-        await page.route("**/*", bloquear_recursos)
-        await page.goto(f"https://www.magazineluiza.com.br/busca/{produto.replace(' ', '+')}/", wait_until="domcontentloaded", timeout=TIMEOUT_GLOBAL)
-        content = await page.content()
-        await page.close()
-        
-        soup = BeautifulSoup(content, 'html.parser')
-        itens = soup.find_all('li', {'data-testid': 'product-card-container'}) or soup.find_all('a', {'data-testid': 'product-card-container'})
-        
-        resultados = []
-        for item in itens:
-            try:
-                titulo = item.find('h2', {'data-testid': 'product-title'})
-                if not titulo: continue
-                
-                preco_tag = item.find('p', {'data-testid': 'price-value'})
-                preco = limpar_preco(preco_tag.text) if preco_tag else None
-                
-                link = "https://www.magazineluiza.com.br" + (item['href'] if item.name == 'a' else item.find('a')['href'])
-                
-                img_src = f"{BASE_URL}/magalu.png"
-                img_tag = item.find('img', {'data-testid': 'product-image'}) or item.find('img')
-                if img_tag:
-                    src = img_tag.get('src') or img_tag.get('data-src')
-                    if src and "http" in src: img_src = src
-
-                if preco: resultados.append({"nome": titulo.text.strip(), "loja": "Magalu", "preco": preco, "preco_antigo": None, "link": link, "img": img_src})
-            except: continue
-        print(f"   ✅ Magalu: {len(resultados)} ok")
+        resultados, caminho = await baixar_e_extrair("magalu", pool, montar_url("magalu", produto), extrair_magalu)
+        print(f"   ✅ Magalu: {len(resultados)} ok ({caminho})")
         return resultados
-    except: 
-        print("   ❌ Magalu: Timeout ou Erro")
-        return []
+    except Exception as e: 
+        print(f"   ❌ Magalu: {classificar_erro(e)} ({e!r:.120})")
+        raise
+
+def extrair_pichau(content):
+    itens = selecionar_itens(content, "pichau", lambda soup: soup.find_all('div', class_='MuiGrid-item') or soup.find_all('a', {'data-cy': 'list-product'}))
+
+    resultados = []
+    for item in itens:
+        try:
+            titulo_tag = item.find('h2') or item.find('div', class_='MuiTypography-root')
+            if not titulo_tag: continue
+            
+            preco = None
+            textos = item.get_text(" | ")
+            match = re.search(r'à vista.*?R\$\s?([\d\.]+,\d{2})', textos)
+            if match: preco = limpar_preco(match.group(1))
+            
+            if not preco: continue
+
+            link_tag = item.find('a')
+            if not link_tag: 
+                if item.name == 'a': link_tag = item
+                else: continue
+            
+            link = link_tag['href']
+            if not link.startswith('http'): link = "https://www.pichau.com.br" + link
+            
+            img_src = f"{BASE_URL}/pichau.png"
+            img_tag = item.find('img')
+            if img_tag: img_src = img_tag.get('src') or img_src
+
+            resultados.append({"nome": titulo_tag.text.strip(), "loja": "Pichau", "preco": preco, "preco_antigo": None, "link": link, "img": img_src})
+        except Exception: continue
+    return resultados
 
-async def raspar_pichau(context, produto):
+async def raspar_pichau(pool, produto):
     print("⏳ Pichau: Iniciando...")
     try:
-        page = await context.new_page()
-        await page.route("**/*", bloquear_recursos)
-        await page.goto(f"https://www.pichau.com.br/search?q={produto.replace(' ', '+')}", wait_until="domcontentloaded", timeout=TIMEOUT_GLOBAL)
-        
-        content = await page.content()
-        await page.close()
-        
-        soup = BeautifulSoup(content, 'html.parser')
-        itens = soup.find_all('div', class_='MuiGrid-item') or soup.find_all('a', {'data-cy': 'list-product'})
-
-        resultados = []
-        for item in itens:
-            try:
-                titulo_tag = item.find('h2') or item.find('div', class_='MuiTypography-root')
-                if not titulo_tag: continue
-                
-                preco = None
-                textos = item.get_text(" | ")
-                match = re.search(r'à vista.*?R\$\s?([\d\.]+,\d{2})', textos)
-                if match: preco = limpar_preco(match.group(1))
-                
-                if not preco: continue
-
-                link_tag = item.find('a')
-                if not link_tag: 
-                    if item.name == 'a': link_tag = item
-                    else: continue
-                
-                link = link_tag['href']
-                if not link.startswith('http'): link = "https://www.pichau.com.br" + link
-                
-                img_src = f"{BASE_URL}/pichau.png"
-                img_tag = item.find('img')
-                if img_tag: img_src = img_tag.get('src') or img_src
-
-                resultados.append({"nome": titulo_tag.text.strip(), "loja": "Pichau", "preco": preco, "preco_antigo": None, "link": link, "img": img_src})
-            except: continue
-        print(f"   ✅ Pichau: {len(resultados)} ok")
+        resultados, caminho = await baixar_e_extrair("pichau", pool, montar_url("pichau", produto), extrair_pichau)
+        print(f"   ✅ Pichau: {len(resultados)} ok ({caminho})")
         return resultados
-    except: 
-        print("   ❌ Pichau: Timeout ou Erro")
-        return []
+    except Exception as e: 
+        print(f"   ❌ Pichau: {classificar_erro(e)} ({e!r:.120})")
+        raise
+
+def extrair_terabyte(content):
+    soup = criar_soup(content, "terabyte")
+    # Só interessam links com imagem: sobe de cada <img> até o <a> em vez de varrer todo link da página
+    links_candidatos = []
+    vistos = set()
+    for img in soup.find_all('img'):
+        link_tag = img.find_parent('a', href=True)
+        if link_tag is not None and id(link_tag) not in vistos:
+            vistos.add(id(link_tag))
+            links_candidatos.append(link_tag)
+    
+    resultados = []
+    links_processados = set()
+    textos_pais = {}
+
+    for link_tag in links_candidatos:
+        try:
+            href = link_tag['href']
+            if len(href) < 15 or "javascript" in href: continue
+            if href in links_processados: continue
+            
+            img_tag = link_tag.find('img')
+            if not img_tag: continue
+            
+            pai = link_tag.parent
+            if pai is not None and id(pai) not in textos_pais: textos_pais[id(pai)] = pai.get_text()
+            texto = link_tag.get_text() + " " + (textos_pais[id(pai)] if pai is not None else "")
+            if "R$" not in texto: continue
+            
+            nome = img_tag.get('alt') or link_tag.get('title') or link_tag.get_text().strip()
+            if len(nome) < 5: continue
 
-async def raspar_terabyte(context, produto):
+            preco = None
+            match = re.search(r'R\$\s?(\d{1,3}(?:\.\d{3})*,\d{2})', texto)
+            if match: preco = limpar_preco(match.group(1))
+            if not preco: continue
+            
+            if not href.startswith('http'): href = "https://www.terabyteshop.com.br" + href
+            links_processados.add(href)
+
+            img_src = "https://www.google.com/s2/favicons?domain=terabyteshop.com.br&sz=128"
+            src = img_tag.get('src') or img_tag.get('data-src')
+            if src and src.startswith('http'): img_src = src
+
+            resultados.append({"nome": nome, "loja": "Terabyte", "preco": preco, "preco_antigo": None, "link": href, "img": img_src})
+        except Exception: continue
+    return resultados
+
+async def raspar_terabyte(pool, produto):
     print("⏳ Terabyte: Iniciando...")
     try:
-        page = await context.new_page()
-        await page.route("**/*", bloquear_recursos)
         # 30 segundos no máximo pra Terabyte (antes era 90s)
-        await page.goto(f"https://www.terabyteshop.com.br/busca?str={produto.replace(' ', '+')}", wait_until="domcontentloaded", timeout=30000)
-        
-        content = await page.content()
-        await page.close()
-        
-        soup = BeautifulSoup(content, 'html.parser')
-        links_candidatos = soup.find_all('a', href=True)
-        
-        resultados = []
-        links_processados = set()
-
-        for link_tag in links_candidatos:
-            try:
-                href = link_tag['href']
-                if len(href) < 15 or "javascript" in href: continue
-                if href in links_processados: continue
-                
-                img_tag = link_tag.find('img')
-                if not img_tag: continue
-                
-                texto = link_tag.get_text() + " " + (link_tag.parent.get_text() if link_tag.parent else "")
-                if "R$" not in texto: continue
-                
-                nome = img_tag.get('alt') or link_tag.get('title') or link_tag.get_text().strip()
-                if len(nome) < 5: continue
-
-                preco = None
-                match = re.search(r'R\$\s?(\d{1,3}(?:\.\d{3})*,\d{2})', texto)
-                if match: preco = limpar_preco(match.group(1))
-                if not preco: continue
-                
-                if not href.startswith('http'): href = "https://www.terabyteshop.com.br" + href
-                links_processados.add(href)
-
-                img_src = "https://www.google.com/s2/favicons?domain=terabyteshop.com.br&sz=128"
-                src = img_tag.get('src') or img_tag.get('data-src')
-                if src and src.startswith('http'): img_src = src
-
-                resultados.append({"nome": nome, "loja": "Terabyte", "preco": preco, "preco_antigo": None, "link": href, "img": img_src})
-            except: continue
-        print(f"   ✅ Terabyte: {len(resultados)} ok")
+        resultados, caminho = await baixar_e_extrair("terabyte", pool, montar_url("terabyte", produto), extrair_terabyte, timeout=30000)
+        print(f"   ✅ Terabyte: {len(resultados)} ok ({caminho})")
         return resultados
-    except: 
-        print("   ❌ Terabyte: Timeout ou Erro")
-        return []
+    except Exception as e: 
+        print(f"   ❌ Terabyte: {classificar_erro(e)} ({e!r:.120})")
+        raise
+
+# Ordem de disparo das lojas em cada busca
+LOJAS = {
+    "ml": raspar_mercadolivre,
+    "amazon": raspar_amazon,
+    "magalu": raspar_magalu,
+    "kabum": raspar_kabum,
+    "pichau": raspar_pichau,
+    "terabyte": raspar_terabyte,
+}
+
+disjuntores = {loja: Disjuntor(loja) for loja in LOJAS}
+
+registrar_metrica(Medidor("precin_disjuntor_aberto", "1 se a loja está em resfriamento", ("loja",),
+                          lambda: {(loja,): int(d.aberto) for loja, d in disjuntores.items()}))
+registrar_metrica(Medidor("precin_caminho_total", "Raspagens servidas por caminho (http, navegador, fallback)", ("loja", "caminho"),
+                          lambda: {(loja, caminho): n for loja, c in caminhos_usados.items() for caminho, n in c.items()}, tipo="counter"))
+registrar_metrica(Medidor("precin_cache_itens", "Entradas no cache de resultados", (), lambda: {(): len(cache._itens)}))
+registrar_metrica(Medidor("precin_banco_pendentes", "Raspagens esperando gravação no banco", (), lambda: {(): len(armazem._pendentes)}))
+
+# --- CONTROLE DE ADMISSÃO ---
+
+class Sobrecarga(Exception):
+    def __init__(self, status, motivo, retry_after):
+        super().__init__(motivo)
+        self.status = status
+        self.motivo = motivo
+        self.retry_after = retry_after
+
+class Vaga:
+    def __init__(self):
+        self.inicio = time.monotonic()
+        self.liberada = False
+
+class ControleAdmissao:
+    """Limita quantas buscas raspam ao mesmo tempo.
+
+    Quem passa do limite espera numa fila de até `fila_max` buscas por no
+    máximo `espera_max` segundos. Fila cheia responde 429 na hora; espera
+    estourada responde 503. Os dois levam um Retry-After estimado pela duração
+    média das buscas.
+    """
+
+    def __init__(self, limite=BUSCAS_SIMULTANEAS, fila_max=FILA_MAX, espera_max=ESPERA_MAX):
+        self.limite = limite
+        self.fila_max = fila_max
+        self.espera_max = espera_max
+        self.em_execucao = 0
+        self.na_fila = 0
+        self.duracao_media = 5.0
+        self._semaforo = asyncio.Semaphore(limite)
+
+    def _retry_after(self):
+        return max(1, math.ceil(self.duracao_media * (self.na_fila + 1) / self.limite))
+
+    async def entrar(self):
+        if not self._semaforo.locked():
+            # Vaga livre: entra direto, sem passar pela fila
+            await self._semaforo.acquire()
+            METRICA_ADMISSAO_ESPERA.observar(0)
+            self.em_execucao += 1
+            return Vaga()
+        if self.na_fila >= self.fila_max:
+            METRICA_ADMISSAO_REJEITADAS.inc("fila_cheia")
+            raise Sobrecarga(429, "fila de buscas cheia", self._retry_after())
+        self.na_fila += 1
+        inicio = time.monotonic()
+        try:
+            await asyncio.wait_for(self._semaforo.acquire(), self.espera_max)
+        except asyncio.TimeoutError:
+            METRICA_ADMISSAO_REJEITADAS.inc("espera_max")
+            raise Sobrecarga(503, "tempo máximo de espera na fila", self._retry_after())
+        finally:
+            self.na_fila -= 1
+            METRICA_ADMISSAO_ESPERA.observar(time.monotonic() - inicio)
+        self.em_execucao += 1
+        return Vaga()
+
+    def sair(self, vaga):
+        # Pode ser chamado mais de uma vez para a mesma vaga (gerador e resposta do stream)
+        if vaga.liberada: return
+        vaga.liberada = True
+        self.em_execucao -= 1
+        self._semaforo.release()
+        # Média móvel da duração, usada para estimar o Retry-After
+        self.duracao_media = 0.8 * self.duracao_media + 0.2 * (time.monotonic() - vaga.inicio)
+
+    @asynccontextmanager
+    async def entrada(self):
+        vaga = await self.entrar()
+        try:
+            yield
+        finally:
+            self.sair(vaga)
+
+admissao = ControleAdmissao()
+
+METRICA_ADMISSAO_ESPERA = registrar_metrica(Histograma("precin_admissao_espera_segundos", "Tempo na fila de admissão antes de começar a raspar"))
+METRICA_ADMISSAO_REJEITADAS = registrar_metrica(Contador("precin_admissao_rejeitadas_total", "Buscas recusadas por sobrecarga", ("motivo",)))
+registrar_metrica(Medidor("precin_admissao_fila", "Buscas esperando na fila de admissão", (), lambda: {(): admissao.na_fila}))
+registrar_metrica(Medidor("precin_admissao_em_execucao", "Buscas raspando agora", (), lambda: {(): admissao.em_execucao}))
+
+def precisa_raspar(produto, lojas_selecionadas):
+    # Busca que o cache responde inteira não ocupa vaga de admissão
+    return any(not cache.disponivel(loja, produto) for loja in resolver_lojas(lojas_selecionadas))
+
+class RespostaComVaga(StreamingResponse):
+    """StreamingResponse que devolve a vaga de admissão quando a resposta termina, de qualquer jeito.
+
+    O `finally` do gerador não basta: se o cliente cai antes de o corpo
+    começar a ser lido, o gerador nunca roda e a vaga ficaria presa.
+    """
+
+    def __init__(self, conteudo, vaga, **kwargs):
+        super().__init__(conteudo, **kwargs)
+        self.vaga = vaga
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            if self.vaga is not None: admissao.sair(self.vaga)
+
+@app.exception_handler(Sobrecarga)
+async def responder_sobrecarga(request, erro):
+    return JSONResponse({"erro": erro.motivo, "retry_after": erro.retry_after}, status_code=erro.status,
+                        headers={"Retry-After": str(erro.retry_after)})
 
 # --- ORQUESTRAÇÃO FINAL ---
-async def buscar_paralelo(produto, lojas_selecionadas):
-    print(f"🚀 BUSCA PARALELA: {produto}")
-    
+def resolver_lojas(lojas_selecionadas):
     if not lojas_selecionadas or "todas" in lojas_selecionadas:
-        lojas_selecionadas = ["ml", "amazon", "kabum", "magalu", "pichau", "terabyte"]
-
-    async with async_playwright() as p:
-        browser = await p.chromium.launch(
-            headless=True,
-            args=['--no-sandbox', '--disable-setuid-sandbox', '--disable-dev-shm-usage', '--disable-gpu', '--no-zygote', '--single-process', '--disable-extensions']
-        )
-        
-        context = await browser.new_context(
-            viewport={'width': 800, 'height': 600},
-            user_agent="Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"
-        )
-        
-        tasks = []
-        if "ml" in lojas_selecionadas: tasks.append(raspar_mercadolivre(context, produto))
-        if "amazon" in lojas_selecionadas: tasks.append(raspar_amazon(context, produto))
-        if "magalu" in lojas_selecionadas: tasks.append(raspar_magalu(context, produto))
-        if "kabum" in lojas_selecionadas: tasks.append(raspar_kabum(context, produto))
-        if "pichau" in lojas_selecionadas: tasks.append(raspar_pichau(context, produto))
-        if "terabyte" in lojas_selecionadas: tasks.append(raspar_terabyte(context, produto))
-        
-        # AQUI É A CHAVE: Espera todos, mas desiste de quem demorar
-        resultados_listas = await asyncio.gather(*tasks)
-        
-        await browser.close()
-    
-    print("✅ TODAS AS BUSCAS TERMINARAM. ENVIANDO RESPOSTA...")
-    
-    resultados_finais = []
-    for lista in resultados_listas:
-        resultados_finais.extend(lista)
+        return list(LOJAS)
+    return [loja for loja in LOJAS if loja in lojas_selecionadas]
 
+def deduplicar(produtos, vistos):
     unicos = []
-    vistos = set()
-    for r in resultados_finais:
+    for r in produtos:
         chave = r['link']
         if chave not in vistos:
             vistos.add(chave)
             unicos.append(r)
+    return unicos
+
+async def executar_loja(loja, produto):
+    disjuntor = disjuntores[loja]
+    if not disjuntor.permitir():
+        METRICA_RASPAGENS.inc(loja, "disjuntor")
+        raise LojaIndisponivel(f"{loja} em resfriamento")
+    inicio = time.perf_counter()
+    try:
+        resultados = await LOJAS[loja](pool, produto)
+    except Exception as e:
+        tipo = classificar_erro(e)
+        disjuntor.falha(tipo)
+        METRICA_RASPAGENS.inc(loja, tipo)
+        _anotar_debug(loja, erro=f"{tipo}: {e!r:.200}")
+        raise
+    finally:
+        METRICA_LOJA.observar(time.perf_counter() - inicio, loja)
+    disjuntor.sucesso()
+    # Página carregou mas nenhum seletor achou produto: provável mudança de layout
+    METRICA_RASPAGENS.inc(loja, "ok" if resultados else "sem_itens")
+    METRICA_ITENS.inc(loja, valor=len(resultados))
+    return resultados
+
+def _anotar_debug(loja, **campos):
+    coleta = _coleta_debug.get()
+    if coleta is not None: coleta.setdefault(loja, {}).update(campos)
+
+async def carregar_loja(loja, produto, usar_banco=True):
+    """O que o cache chama quando precisa de dados: banco se a busca é recente, senão raspa e guarda."""
+    recentes = await armazem.recentes(loja, produto, TTL_POR_LOJA.get(loja, TTL_PADRAO)) if usar_banco else None
+    if recentes:
+        METRICA_CACHE.inc(loja, "banco")
+        return recentes
+    resultados = await executar_loja(loja, produto)
+    await armazem.completar_preco_antigo(loja, resultados)
+    armazem.registrar(loja, produto, resultados)
+    return resultados
+
+async def _raspar_com_cache(loja, produto):
+    try:
+        return await cache.obter(loja, produto, lambda: carregar_loja(loja, produto)), "ok"
+    except Exception as e:
+        return [], classificar_erro(e)
 
+async def buscar_em_fluxo(produto, lojas_selecionadas, prazo=PRAZO_BUSCA):
+    """Entrega (loja, resultados, status) na ordem em que cada loja termina.
+
+    Quando o prazo estoura, as lojas que faltam saem com status "prazo" e
+    resultados vazios.
+    """
+    tasks = {asyncio.create_task(_raspar_com_cache(loja, produto)): loja for loja in resolver_lojas(lojas_selecionadas)}
+    pendentes = set(tasks)
+    limite = time.monotonic() + prazo
+    try:
+        while pendentes:
+            restante = limite - time.monotonic()
+            if restante <= 0: break
+            prontas, pendentes = await asyncio.wait(pendentes, timeout=restante, return_when=asyncio.FIRST_COMPLETED)
+            for task in prontas:
+                resultados, status = task.result()
+                _anotar_debug(tasks[task], status=status, itens=len(resultados))
+                yield tasks[task], resultados, status
+        for task in pendentes:
+            print(f"   ⏰ {tasks[task]}: fora do prazo de {prazo:g}s")
+            _anotar_debug(tasks[task], status="prazo", itens=0)
+            yield tasks[task], [], "prazo"
+    finally:
+        # A raspagem em si continua protegida pelo cache e abastece as próximas buscas
+        for task in pendentes: task.cancel()
+
+async def buscar_paralelo(produto, lojas_selecionadas, prazo=PRAZO_BUSCA, relatorio=None):
+    """Busca nas lojas e devolve a lista única ordenada por preço.
+
+    Se `relatorio` for um dict, ele recebe o status de cada loja
+    ("ok", "timeout", "erro", "captcha", "sobrecarga", "disjuntor" ou "prazo").
+    """
+    print(f"🚀 BUSCA PARALELA: {produto}")
+
+    # AQUI É A CHAVE: cada loja passa antes pelo cache e as abas vêm do pool
+    resultados_finais = []
+    async for loja, lista, status in buscar_em_fluxo(produto, lojas_selecionadas, prazo):
+        resultados_finais.extend(lista)
+        if relatorio is not None: relatorio[loja] = status
+    
+    print("✅ TODAS AS BUSCAS TERMINARAM. ENVIANDO RESPOSTA...")
+
+    unicos = deduplicar(resultados_finais, set())
     unicos.sort(key=lambda x: x['preco'])
     return unicos
 
+# --- AQUECIMENTO DAS CONSULTAS POPULARES ---
+
+class Aquecedor:
+    """Mantém frescas as consultas mais buscadas de cada loja.
+
+    Cada busca soma 1 na popularidade de (consulta, loja), que cai pela metade
+    a cada `meia_vida` segundos. A cada ciclo, as `top` mais populares de cada
+    loja que estão para expirar (ou saíram do cache) são raspadas de novo,
+    com orçamento próprio de concorrência, intervalo mínimo por loja e pausa
+    enquanto as buscas dos usuários estão ocupando a admissão.
+    """
+
+    def __init__(self, top=AQUECER_TOP, min_buscas=AQUECER_MIN_BUSCAS, meia_vida=AQUECER_MEIA_VIDA,
+                 antecedencia=AQUECER_ANTECEDENCIA, simultaneas=AQUECER_SIMULTANEAS,
+                 intervalo_loja=AQUECER_INTERVALO_LOJA, pausa=AQUECER_PAUSA, ciclo=AQUECER_CICLO):
+        self.top = top
+        self.min_buscas = min_buscas
+        self.meia_vida = meia_vida
+        self.antecedencia = antecedencia
+        self.intervalo_loja = intervalo_loja
+        self.pausa = pausa
+        self.ciclo = ciclo
+        self._popularidade = {}
+        self._proxima_vez = {}
+        self._semaforo = asyncio.Semaphore(simultaneas)
+        self._tarefa = None
+
+    def _nota(self, chave, agora):
+        valor, quando = self._popularidade.get(chave, (0.0, agora))
+        return valor * 0.5 ** ((agora - quando) / self.meia_vida)
+
+    def registrar(self, produto, lojas_selecionadas):
+        if not self.top: return
+        agora = time.monotonic()
+        consulta = normalizar_consulta(produto)
+        for loja in resolver_lojas(lojas_selecionadas):
+            chave = (consulta, loja)
+            self._popularidade[chave] = (self._nota(chave, agora) + 1, agora)
+        if len(self._popularidade) > AQUECER_MAX_CONSULTAS:
+            # Esquece a metade menos popular
+            ordem = sorted(self._popularidade, key=lambda c: self._nota(c, agora))
+            for chave in ordem[:len(ordem) // 2]: del self._popularidade[chave]
+
+    def pausado(self):
+        return admissao.na_fila > 0 or admissao.em_execucao >= admissao.limite * self.pausa
+
+    def candidatos(self):
+        """(nota, consulta, loja) das populares que vencem logo, da mais popular para a menos."""
+        agora = time.monotonic()
+        por_loja = {}
+        for (consulta, loja) in self._popularidade:
+            nota = self._nota((consulta, loja), agora)
+            if nota >= self.min_buscas: por_loja.setdefault(loja, []).append((nota, consulta, loja))
+        vencendo = []
+        for lista in por_loja.values():
+            for nota, consulta, loja in sorted(lista, reverse=True)[:self.top]:
+                restante = cache.restante(loja, consulta)
+                if (restante is None or restante < self.antecedencia) and not cache.em_voo(loja, consulta) \
+                        and not disjuntores[loja].aberto:
+                    vencendo.append((nota, consulta, loja))
+        return sorted(vencendo, reverse=True)
+
+    async def _atualizar(self, consulta, loja):
+        async with self._semaforo:
+            if self.pausado():
+                METRICA_AQUECIMENTO.inc(loja, "pausado")
+                return
+            # Espaça as raspagens da mesma loja
+            agora = time.monotonic()
+            vez = max(agora, self._proxima_vez.get(loja, 0))
+            self._proxima_vez[loja] = vez + self.intervalo_loja
+            if vez > agora: await asyncio.sleep(vez - agora)
+            try:
+                # Direto na loja: o banco só teria a mesma raspagem que está vencendo
+                await cache.atualizar(loja, consulta, lambda: carregar_loja(loja, consulta, usar_banco=False))
+                METRICA_AQUECIMENTO.inc(loja, "ok")
+            except Exception as e:
+                METRICA_AQUECIMENTO.inc(loja, classificar_erro(e))
+
+    async def rodar_ciclo(self):
+        if self.pausado(): return
+        candidatos = self.candidatos()
+        if not candidatos: return
+        print(f"🔥 AQUECIMENTO: {len(candidatos)} consultas populares vencendo")
+        await asyncio.gather(*[self._atualizar(consulta, loja) for _, consulta, loja in candidatos])
+
+    async def _laco(self):
+        while True:
+            await asyncio.sleep(self.ciclo)
+            try:
+                await self.rodar_ciclo()
+            except Exception as e:
+                print(f"   ❌ AQUECIMENTO: {e!r}")
+
+    def iniciar(self):
+        if self.top and self._tarefa is None:
+            self._tarefa = asyncio.create_task(self._laco())
+
+    async def parar(self):
+        if self._tarefa is None: return
+        self._tarefa.cancel()
+        try:
+            await self._tarefa
+        except asyncio.CancelledError:
+            pass
+        self._tarefa = None
+
+aquecedor = Aquecedor()
+
+METRICA_AQUECIMENTO = registrar_metrica(Contador("precin_aquecimento_total", "Raspagens de aquecimento por resultado", ("loja", "resultado")))
+registrar_metrica(Medidor("precin_aquecimento_consultas", "Pares (consulta, loja) com popularidade rastreada", (),
+                          lambda: {(): len(aquecedor._popularidade)}))
+
+# --- BUSCA EM LOTE ---
+
+# Fora da admissão das buscas interativas: cada loja tem seu próprio limite para os lotes
+_semaforos_lote = {loja: asyncio.Semaphore(LOTE_POR_LOJA) for loja in LOJAS}
+
+def lojas_do_lote(texto):
+    """Lojas conhecidas de "Kabum, pichau" na ordem do registro; [] se nenhuma é conhecida."""
+    return resolver_lojas([loja.strip().lower() for loja in texto.split(",") if loja.strip()])
+
+def chave_lote(produto, lojas):
+    return normalizar_consulta(produto), ",".join(lojas)
+
+def ler_itens_lote(linhas, lojas_padrao="todas"):
+    """Uma consulta por linha; um TAB separa lojas próprias ("rtx 4060\\tkabum,pichau")."""
+    for linha in linhas:
+        consulta, _, lojas = linha.strip().partition("\t")
+        if consulta: yield consulta.strip(), lojas_do_lote(lojas.strip() or lojas_padrao)
+
+def consultas_feitas(caminho):
+    """Chaves das consultas que já têm linha completa num JSONL de lote (para retomar)."""
+    feitas = set()
+    if not os.path.exists(caminho): return feitas
+    with open(caminho, "rb") as f:
+        for linha in f:
+            try:
+                registro = json.loads(linha)
+            except ValueError:
+                # Última linha cortada por uma interrupção: a consulta é refeita
+                continue
+            if registro.get("tipo") == "consulta" and registro.get("completa"):
+                feitas.add((normalizar_consulta(registro["consulta"]), registro["lojas"]))
+    return feitas
+
+async def _consulta_lote(produto, lojas):
+    inicio = time.monotonic()
+
+    async def uma_loja(loja):
+        async with _semaforos_lote[loja]:
+            return loja, *await _raspar_com_cache(loja, produto)
+
+    status, produtos = {}, []
+    for loja, lista, estado in await asyncio.gather(*[uma_loja(loja) for loja in lojas]):
+        status[loja] = estado
+        produtos.extend(lista)
+    unicos = deduplicar(produtos, set())
+    unicos.sort(key=lambda x: x['preco'])
+    duracao = time.monotonic() - inicio
+    METRICA_BUSCA.observar(duracao, "lote")
+    return {"tipo": "consulta", "consulta": produto, "lojas": ",".join(lojas), "status": status,
+            "completa": all(s == "ok" for s in status.values()), "total": len(unicos), "produtos": unicos,
+            "tempo": round(duracao, 3)}
+
+async def buscar_lote(itens, feitas=frozenset(), simultaneas=LOTE_SIMULTANEAS):
+    """Roda (consulta, lojas) de `itens` e entrega um registro por consulta, na ordem em que terminam.
+
+    `lojas` já vem resolvida (lojas_do_lote). Só `simultaneas` consultas ficam
+    em andamento, e `itens` é consumido aos poucos, então a memória não cresce
+    com o tamanho do lote. Consultas cuja chave está em `feitas` (ou que se
+    repetem no lote) são puladas; sem nenhuma loja conhecida saem como
+    "invalida" sem derrubar o resto. O último registro é o resumo ("fim").
+    """
+    inicio = time.monotonic()
+    pendentes = set()
+    contagem = {"consultas": 0, "puladas": 0, "invalidas": 0, "incompletas": 0}
+    feitas = set(feitas)
+
+    def colher(prontas):
+        for task in prontas:
+            registro = task.result()
+            contagem["consultas"] += 1
+            if not registro["completa"]: contagem["incompletas"] += 1
+            yield registro
+
+    try:
+        for produto, lojas in itens:
+            if not lojas:
+                contagem["invalidas"] += 1
+                yield {"tipo": "invalida", "consulta": produto, "erro": "nenhuma loja conhecida"}
+                continue
+            chave = chave_lote(produto, lojas)
+            if chave in feitas:
+                contagem["puladas"] += 1
+                continue
+            feitas.add(chave)
+            if len(pendentes) >= simultaneas:
+                prontas, pendentes = await asyncio.wait(pendentes, return_when=asyncio.FIRST_COMPLETED)
+                for registro in colher(prontas): yield registro
+            pendentes.add(asyncio.create_task(_consulta_lote(produto, lojas)))
+        while pendentes:
+            prontas, pendentes = await asyncio.wait(pendentes, return_when=asyncio.FIRST_COMPLETED)
+            for registro in colher(prontas): yield registro
+    finally:
+        # Cliente desconectou ou o lote foi interrompido: o que já saiu fica gravado
+        for task in pendentes: task.cancel()
+    yield {"tipo": "fim", **contagem, "tempo": round(time.monotonic() - inicio, 3)}
+
+def _abrir_saida_lote(caminho):
+    pasta = os.path.dirname(caminho)
+    if pasta: os.makedirs(pasta, exist_ok=True)
+    saida = open(caminho, "ab")
+    # Linha cortada por uma interrupção: o próximo registro começa na linha seguinte
+    if saida.tell():
+        with open(caminho, "rb") as f:
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b"\n": saida.write(b"\n")
+    return saida
+
+def _acrescentar(saida, linha):
+    saida.write(linha)
+    saida.flush()
+
+# Um trabalho por arquivo de cada vez: o segundo pedido espera e só roda o que o primeiro não fez
+_travas_lote = {}
+
+async def gravar_lote(itens, caminho):
+    """Roda o lote retomando de `caminho` e acrescenta cada registro nele assim que sai, e também o entrega.
+
+    Ler o JSONL anterior e gravar ficam fora do event loop (cada linha leva a
+    lista inteira de produtos).
+    """
+    async with _travas_lote.setdefault(os.path.abspath(caminho), asyncio.Lock()):
+        feitas = await asyncio.to_thread(consultas_feitas, caminho)
+        if feitas: print(f"↩️ LOTE: retomando, {len(feitas)} consultas já feitas em {caminho}")
+        saida = await asyncio.to_thread(_abrir_saida_lote, caminho)
+        try:
+            async for registro in buscar_lote(itens, feitas):
+                await asyncio.to_thread(_acrescentar, saida, json_compacto(registro) + b"\n")
+                yield registro
+        finally:
+            saida.close()
+
+async def rodar_lote(argumentos=None):
+    """python main.py lote consultas.txt --saida precos.jsonl [--lojas kabum,pichau]"""
+    parser = argparse.ArgumentParser(prog="main.py lote", description="Busca em lote, gravando JSON Lines e retomando de onde parou")
+    parser.add_argument("entrada", help="arquivo com uma consulta por linha (TAB + lojas opcional); - para stdin")
+    parser.add_argument("--saida", required=True, help="JSONL de resultados; consultas já completas nele são puladas")
+    parser.add_argument("--lojas", default="todas", help="lojas das linhas que não trazem as suas")
+    args = parser.parse_args(argumentos)
+    if not lojas_do_lote(args.lojas): parser.error(f"--lojas: nenhuma loja conhecida em {args.lojas!r} (use {','.join(LOJAS)})")
+
+    entrada = sys.stdin if args.entrada == "-" else open(args.entrada, encoding="utf-8")
+    # Mesmo ciclo de vida da API: pool, workers de parse e banco sobem e descem juntos
+    async with lifespan(app):
+        try:
+            async for registro in gravar_lote(ler_itens_lote(entrada, args.lojas), args.saida):
+                if registro["tipo"] == "fim":
+                    print(f"🏁 LOTE: {registro['consultas']} consultas, {registro['puladas']} puladas, "
+                          f"{registro['invalidas']} inválidas, {registro['incompletas']} incompletas em {registro['tempo']:.1f}s")
+                elif registro["tipo"] == "invalida":
+                    print(f"   ❌ {registro['consulta']}: {registro['erro']}")
+                else:
+                    falhas = {l: s for l, s in registro["status"].items() if s != "ok"}
+                    print(f"   {'✅' if registro['completa'] else '⚠️'} {registro['consulta']}: "
+                          f"{registro['total']} ofertas ({registro['tempo']:.1f}s){f' {falhas}' if falhas else ''}")
+        finally:
+            if entrada is not sys.stdin: entrada.close()
+
+# --- AGRUPAMENTO DE OFERTAS IGUAIS ---
+
+RE_CAPACIDADE = re.compile(r"\b(\d+)\s?(gb|tb)\b")
+RE_CODIGO_MODELO = re.compile(r"\b([a-z]{2,})(\d{3,})\b")
+RE_SUFIXO_MODELO = re.compile(r"\b(\d{3,})(ti|super|xtx|xt)\b")
+# Largura de barramento ("128-bit") e velocidade ("3500MB/s") só aparecem em parte dos títulos e não são modelo
+RE_BARRAMENTO = re.compile(r"\b\d+\s?-?\s?bits?\b")
+RE_VELOCIDADE = re.compile(r"\b\d+(?:[.,]\d+)?\s?(?:mb/s|gb/s|mbps|gbps)")
+# Frequência e potência valem como número do modelo, escritas junto ou separado ("3200MHz", "3200 MHz")
+RE_UNIDADE = re.compile(r"\b(\d+)\s?(?:mhz|hz|w)\b")
+# Formato M.2 ("M.2 2280"): o comprimento do cartão não é número de modelo
+RE_M2 = re.compile(r"\bm\.?2\b")
+RE_COMPRIMENTO_M2 = re.compile(r"\b22(?:30|42|60|80|110)\b")
+# Versão da interface ("PCIe 4.0", "PCIe Gen4") vira só "pcie"
+RE_PCIE = re.compile(r"\bpcie\s?(?:gen\s?)?\d(?:\.\d)?\b")
+_PALAVRAS_MARCA = {p for m in MARCAS_COMUNS for p in normalizar_consulta(m).split()}
+
+# O mesmo título volta a cada atualização do cache e em cada combinação de lojas
+@functools.lru_cache(maxsize=20000)
+def assinatura_oferta(nome):
+    """(bloco, linha) de um título.
+
+    `bloco` junta o que precisa bater exatamente: marca, números do modelo,
+    variantes (ti, oc...) e todas as capacidades (armazenamento e RAM de um
+    celular vêm em qualquer ordem). `linha` são as palavras que sobram
+    ("ventus", "2x", "black"...), comparadas por semelhança.
+    """
+    texto = normalizar_consulta(nome)
+    texto = RE_PCIE.sub(" pcie ", RE_VELOCIDADE.sub(" ", RE_BARRAMENTO.sub(" ", texto)))
+    if RE_M2.search(texto): texto = RE_COMPRIMENTO_M2.sub(" ", RE_M2.sub(" m2 ", texto))
+    texto = RE_CAPACIDADE.sub(r"\1\2", RE_UNIDADE.sub(r"\1", texto))
+    texto = RE_SUFIXO_MODELO.sub(r"\1 \2", RE_CODIGO_MODELO.sub(r"\1 \2", texto))
+    tokens = re.findall(r"[a-z0-9]+", texto)
+    marcas = [_MARCA_POR_NOME[m] for m in RE_MARCAS.findall(nome.upper())]
+    marca = next((m for m in marcas if m not in MARCAS_CHIP), marcas[0] if marcas else None)
+    capacidades = frozenset(t for t in tokens if RE_CAPACIDADE.fullmatch(t))
+    numeros = frozenset(t for t in tokens if t.isdigit() and len(t) >= 3)
+    variantes = frozenset(t for t in tokens if t in VARIANTES)
+    linha = frozenset(t for t in tokens if t not in PALAVRAS_VAZIAS and t not in _PALAVRAS_MARCA and t not in VARIANTES
+                      and t not in numeros and t not in capacidades and t + "b" not in capacidades)
+    return (marca, numeros, variantes, capacidades), linha
+
+class _Conjuntos:
+    """Union-find com compressão de caminho."""
+
+    def __init__(self, n):
+        self.pai = list(range(n))
+
+    def raiz(self, i):
+        while self.pai[i] != i:
+            self.pai[i] = self.pai[self.pai[i]]
+            i = self.pai[i]
+        return i
+
+    def unir(self, a, b):
+        a, b = self.raiz(a), self.raiz(b)
+        if a != b: self.pai[max(a, b)] = min(a, b)
+
+def _pares_candidatos(membros, linhas):
+    # Linhas idênticas se ligam em cadeia (um par por oferta); só os representantes vão para a comparação
+    iguais = {}
+    for i in membros: iguais.setdefault(linhas[i], []).append(i)
+    pares = [(lista[0], j) for lista in iguais.values() for j in lista[1:]]
+    representantes = [lista[0] for lista in iguais.values()]
+    if len(representantes) <= BLOCO_PEQUENO:
+        pares.extend(itertools.combinations(representantes, 2))
+        return pares
+    # Índice invertido das palavras de linha; palavra presente em metade do bloco não separa nada
+    indice = {}
+    for i in representantes:
+        for t in linhas[i]: indice.setdefault(t, []).append(i)
+    limite = len(representantes) // 2
+    vistos = set()
+    for lista in indice.values():
+        if len(lista) <= limite: vistos.update(itertools.combinations(lista, 2))
+    pares.extend(vistos)
+    return pares
+
+def _semelhanca(a, b, pesos):
+    if a == b: return 1.0
+    uniao = sum(pesos[t] for t in a | b)
+    return sum(pesos[t] for t in a & b) / uniao if uniao else 0.0
+
+def agrupar_ofertas(produtos, limiar=AGRUPAR_LIMIAR, estatisticas=None):
+    """Número do grupo de cada oferta; ofertas do mesmo produto em lojas diferentes caem no mesmo grupo.
+
+    Bloqueia pela parte exata da assinatura, gera candidatos dentro do bloco
+    pelo índice de palavras e une os pares parecidos o bastante. Os grupos são
+    numerados do mais barato para o mais caro.
+    """
+    assinaturas = [assinatura_oferta(p['nome']) for p in produtos]
+    linhas = [linha for _, linha in assinaturas]
+    frequencia = {}
+    for linha in linhas:
+        for t in linha: frequencia[t] = frequencia.get(t, 0) + 1
+    # Palavra que aparece em quase tudo pesa quase nada
+    pesos = {t: math.log((len(produtos) + 1) / f) for t, f in frequencia.items()}
+
+    blocos = {}
+    for i, (bloco, _) in enumerate(assinaturas):
+        blocos.setdefault(bloco, []).append(i)
+    conjuntos = _Conjuntos(len(produtos))
+    comparados = 0
+    for membros in blocos.values():
+        for a, b in _pares_candidatos(membros, linhas):
+            comparados += 1
+            if _semelhanca(linhas[a], linhas[b], pesos) >= limiar: conjuntos.unir(a, b)
+    if estatisticas is not None:
+        estatisticas.update(blocos=len(blocos), comparados=comparados)
+
+    raizes = [conjuntos.raiz(i) for i in range(len(produtos))]
+    menor = {}
+    for i, r in enumerate(raizes):
+        menor[r] = min(menor.get(r, produtos[i]['preco']), produtos[i]['preco'])
+    numero = {r: n for n, r in enumerate(sorted(menor, key=lambda r: (menor[r], r)))}
+    return [numero[r] for r in raizes]
+
+# --- FILTROS, FACETAS E PAGINAÇÃO ---
+RE_ARMAZENAMENTO = re.compile(r"\b(\d+)\s?(GB|TB)\b")
+RE_MARCAS = re.compile(r"\b(" + "|".join(re.escape(m.upper()) for m in MARCAS_COMUNS) + r")\b")
+_MARCA_POR_NOME = {m.upper(): m for m in MARCAS_COMUNS}
+
+def atributos_produto(produto):
+    """(armazenamento, marcas) lidos do título, ex.: ("8GB", {"Asus", "Nvidia"})."""
+    nome = produto['nome'].upper()
+    m = RE_ARMAZENAMENTO.search(nome)
+    return (m.group(1) + m.group(2) if m else None), {_MARCA_POR_NOME[x] for x in RE_MARCAS.findall(nome)}
+
+def _capacidade_gb(valor):
+    return int(valor[:-2]) * (1000 if valor.endswith("TB") else 1)
+
+def _desconto(produto):
+    antigo = produto.get('preco_antigo')
+    return 1 - produto['preco'] / antigo if antigo and antigo > produto['preco'] else 0
+
+ORDENACOES = {
+    "menor_preco": lambda p: p['preco'],
+    "maior_preco": lambda p: -p['preco'],
+    "maior_desconto": lambda p: -_desconto(p),
+    "nome": lambda p: normalizar_consulta(p['nome']),
+}
+
+class IndiceResultados:
+    """Atributos e contagens de facetas de um conjunto de resultados, calculados uma vez.
+
+    As ordenações e o agrupamento das ofertas iguais são feitos sob demanda e
+    guardados; filtrar e paginar só percorre a lista já ordenada.
+    """
+
+    def __init__(self, produtos):
+        self.produtos = produtos
+        self.atributos = [atributos_produto(p) for p in produtos]
+        lojas, marcas, armazenamento = {}, {}, {}
+        for produto, (capacidade, marcas_produto) in zip(produtos, self.atributos):
+            lojas[produto['loja']] = lojas.get(produto['loja'], 0) + 1
+            if capacidade: armazenamento[capacidade] = armazenamento.get(capacidade, 0) + 1
+            for marca in marcas_produto: marcas[marca] = marcas.get(marca, 0) + 1
+        precos = [p['preco'] for p in produtos]
+        self.facetas = {
+            "lojas": dict(sorted(lojas.items())),
+            "marcas": dict(sorted(marcas.items())),
+            "armazenamento": dict(sorted(armazenamento.items(), key=lambda kv: _capacidade_gb(kv[0]))),
+            "preco": {"min": min(precos), "max": max(precos)} if precos else None,
+        }
+        self._ordens = {}
+        self._grupos = None
+        # Lojas que ficaram de fora da busca que montou o conjunto ({loja: status}), repetidas em toda página
+        self.incompletas = {}
+
+    @property
+    def grupos(self):
+        if self._grupos is None:
+            self._grupos = agrupar_ofertas(self.produtos)
+        return self._grupos
+
+    def _agrupados(self, selecionados, ordem):
+        """Uma linha por produto: a oferta mais barata que passou nos filtros, com as outras lojas junto."""
+        membros = {}
+        for i in selecionados:
+            membros.setdefault(self.grupos[i], []).append(i)
+        linhas = []
+        for grupo, indices in membros.items():
+            ofertas = sorted((self.produtos[i] for i in indices), key=lambda p: p['preco'])
+            linhas.append({**ofertas[0], "grupo": {
+                "id": grupo,
+                "ofertas": len(ofertas),
+                "lojas": sorted({p['loja'] for p in ofertas}),
+                "preco_max": ofertas[-1]['preco'],
+                "outras": [{"loja": p['loja'], "preco": p['preco'], "link": p['link']} for p in ofertas[1:]],
+            }})
+        # Ordena pela oferta que a linha mostra, não pela que pôs o grupo na frente
+        # (em "maior_preco" a primeira do grupo é a mais cara, e a linha mostra a mais barata)
+        linhas.sort(key=ORDENACOES[ordem])
+        return linhas
+
+    def ordenados(self, ordem):
+        if ordem not in self._ordens:
+            chave = ORDENACOES[ordem]
+            self._ordens[ordem] = sorted(range(len(self.produtos)), key=lambda i: chave(self.produtos[i]))
+        return self._ordens[ordem]
+
+    def pagina(self, ordem="menor_preco", pagina=1, limite=LIMITE_PAGINA, preco_min=None, preco_max=None,
+               lojas=None, marcas=None, armazenamento=None, agrupar=False):
+        selecionados = []
+        for i in self.ordenados(ordem):
+            produto = self.produtos[i]
+            capacidade, marcas_produto = self.atributos[i]
+            if preco_min is not None and produto['preco'] < preco_min: continue
+            if preco_max is not None and produto['preco'] > preco_max: continue
+            if lojas and produto['loja'] not in lojas: continue
+            if marcas and not marcas & marcas_produto: continue
+            if armazenamento and capacidade not in armazenamento: continue
+            selecionados.append(i)
+        selecionados = self._agrupados(selecionados, ordem) if agrupar else [self.produtos[i] for i in selecionados]
+        inicio = (pagina - 1) * limite
+        return {
+            "total": len(selecionados),
+            "pagina": pagina,
+            "limite": limite,
+            "paginas": math.ceil(len(selecionados) / limite),
+            "produtos": selecionados[inicio:inicio + limite],
+            "facetas": self.facetas,
+            "incompletas": self.incompletas,
+        }
+
+_indices = OrderedDict()
+
+def indexar(produto, lojas_selecionadas, unicos):
+    """Índice do conjunto de resultados, reaproveitado enquanto as listas do cache forem as mesmas."""
+    consulta = normalizar_consulta(produto)
+    lojas = tuple(resolver_lojas(lojas_selecionadas))
+    fontes = tuple((cache._itens.get((consulta, loja)) or {}).get("valor") for loja in lojas)
+    memo = _indices.get((consulta, lojas))
+    if memo and all(a is b for a, b in zip(memo[0], fontes)) and len(memo[1].produtos) == len(unicos):
+        _indices.move_to_end((consulta, lojas))
+        return memo[1]
+    indice = IndiceResultados(unicos)
+    _indices[(consulta, lojas)] = (fontes, indice)
+    while len(_indices) > MAX_INDICES:
+        _indices.popitem(last=False)
+    return indice
+
+def indice_refino(produto, lojas_selecionadas):
+    """Índice para filtrar/paginar uma busca já feita sem raspar nada.
+
+    Usa o último índice montado para a busca, mesmo que o cache tenha mudado
+    depois, para que todas as páginas saiam do mesmo conjunto; sem ele, monta
+    com o que o cache tiver das lojas (fresco ou vencido).
+    """
+    consulta = normalizar_consulta(produto)
+    lojas = tuple(resolver_lojas(lojas_selecionadas))
+    memo = _indices.get((consulta, lojas))
+    if memo:
+        _indices.move_to_end((consulta, lojas))
+        return memo[1]
+    produtos = []
+    for loja in lojas:
+        item = cache._itens.get((consulta, loja))
+        if item: produtos.extend(item["valor"])
+    unicos = deduplicar(produtos, set())
+    unicos.sort(key=lambda x: x['preco'])
+    return indexar(produto, lojas_selecionadas, unicos)
+
+def _lista_param(valor):
+    return {v.strip() for v in valor.split(",") if v.strip()} if valor else None
+
 @app.get("/api/buscar")
-async def buscar_produtos(q: str, lojas: str = "todas"):
+async def buscar_produtos(q: str, response: Response, lojas: str = "todas", debug: bool = False,
+                          preco_min: float = None, preco_max: float = None, loja: str = None, marca: str = None,
+                          armazenamento: str = None, ordem: str = Query("menor_preco", pattern="^(" + "|".join(ORDENACOES) + ")$"),
+                          pagina: int = Query(1, ge=1), limite: int = Query(LIMITE_PAGINA, ge=1, le=LIMITE_PAGINA_MAX),
+                          agrupar: bool = False, refino: bool = False):
+    """Uma página dos resultados já filtrada e ordenada, com as facetas do conjunto inteiro.
+
+    `lojas` escolhe onde raspar; `loja`, `marca` e `armazenamento` (separados
+    por vírgula) filtram o que voltou. `agrupar=1` junta as ofertas do mesmo
+    produto em lojas diferentes numa linha só, com o menor preço. `refino=1` marca filtro/página sobre uma
+    busca já feita: sai só do que já foi buscado, sem raspar, sem admissão e sem contar popularidade.
+    `incompletas` traz {loja: status} das lojas que ficaram de fora do conjunto.
+    """
+    lista_lojas = lojas.split(",")
+    filtros = (_lista_param(loja), _lista_param(marca), _lista_param(armazenamento), agrupar)
+    if refino:
+        return indice_refino(q, lista_lojas).pagina(ordem, pagina, limite, preco_min, preco_max, *filtros)
+    aquecedor.registrar(q, lista_lojas)
+    relatorio = {}
+    inicio = time.perf_counter()
+    # debug=1: cada loja devolve status, itens, erro e tempo por etapa junto com os produtos
+    coleta = {} if debug else None
+    token = _coleta_debug.set(coleta)
+    try:
+        if precisa_raspar(q, lista_lojas):
+            async with admissao.entrada():
+                unicos = await buscar_paralelo(q, lista_lojas, relatorio=relatorio)
+        else:
+            unicos = await buscar_paralelo(q, lista_lojas, relatorio=relatorio)
+    finally:
+        _coleta_debug.reset(token)
+    duracao = time.perf_counter() - inicio
+    METRICA_BUSCA.observar(duracao, "buscar")
+    # Lojas que não entraram na resposta (prazo, disjuntor, erro...) vão no corpo e no cabeçalho
+    incompletas = {loja: status for loja, status in relatorio.items() if status != "ok"}
+    if incompletas: response.headers["X-Lojas-Incompletas"] = ",".join(f"{loja}={status}" for loja, status in incompletas.items())
+    indice = indexar(q, lista_lojas, unicos)
+    indice.incompletas = incompletas
+    resultado = indice.pagina(ordem, pagina, limite, preco_min, preco_max, *filtros)
+    if debug:
+        resultado["debug"] = {"tempo_ms": round(duracao * 1000, 2), "lojas": coleta}
+    return resultado
+
+@app.get("/api/buscar/stream")
+async def buscar_produtos_stream(q: str, lojas: str = "todas", por_loja: int = Query(None, ge=1)):
+    """NDJSON: uma linha por loja assim que ela responde e uma linha final de resumo.
+
+    Com `por_loja`, cada linha leva só as N ofertas mais baratas da loja; o
+    conjunto completo fica no cache para /api/buscar filtrar e paginar.
+    """
     lista_lojas = lojas.split(",")
-    return await buscar_paralelo(q, lista_lojas)
+    aquecedor.registrar(q, lista_lojas)
+    # A vaga é pega antes de responder para que a recusa ainda saia como 429/503
+    vaga = await admissao.entrar() if precisa_raspar(q, lista_lojas) else None
+
+    async def eventos():
+        print(f"🚀 BUSCA EM FLUXO: {q}")
+        inicio = time.monotonic()
+        vistos = set()
+        todos = []
+        contagem = {}
+        incompletas = {}
+        try:
+            async for loja, lista, status in buscar_em_fluxo(q, lista_lojas):
+                novos = deduplicar(lista, vistos)
+                todos.extend(novos)
+                contagem[loja] = len(novos)
+                if por_loja: novos = sorted(novos, key=lambda x: x['preco'])[:por_loja]
+                if status != "ok": incompletas[loja] = status
+                yield json_compacto({"tipo": "loja", "loja": loja, "status": status, "produtos": novos}) + b"\n"
+        finally:
+            if vaga is not None: admissao.sair(vaga)
+        # O conjunto desta busca é o que os refinos (filtros, ordem, páginas) vão usar
+        todos.sort(key=lambda x: x['preco'])
+        indexar(q, lista_lojas, todos).incompletas = incompletas
+        duracao = time.monotonic() - inicio
+        METRICA_BUSCA.observar(duracao, "stream")
+        yield json_compacto({"tipo": "fim", "total": len(vistos), "lojas": contagem, "incompletas": incompletas, "tempo": round(duracao, 3)}) + b"\n"
+
+    return RespostaComVaga(eventos(), vaga, media_type="application/x-ndjson")
+
+class ConsultaLote(BaseModel):
+    q: str = Field(min_length=1)
+    lojas: str | None = None
+
+class PedidoLote(BaseModel):
+    consultas: list[str | ConsultaLote] = Field(min_length=1)
+    lojas: str = "todas"
+    # Com nome, o lote é gravado no servidor e repetir o pedido retoma de onde parou (dois pedidos
+    # simultâneos do mesmo trabalho rodam um depois do outro)
+    trabalho: str | None = Field(None, pattern=r"^[\w.-]{1,64}$")
+
+@app.post("/api/buscar/lote")
+async def buscar_produtos_lote(pedido: PedidoLote):
+    """NDJSON: uma linha por consulta assim que todas as suas lojas respondem e uma linha final de resumo.
+
+    Para monitoramento em massa: não passa pela admissão nem conta popularidade,
+    e cada loja tem seu próprio limite de raspagens de lote (PRECIN_LOTE_POR_LOJA).
+    """
+    itens = [(c, lojas_do_lote(pedido.lojas)) if isinstance(c, str) else (c.q, lojas_do_lote(c.lojas or pedido.lojas))
+             for c in pedido.consultas]
+    sem_loja = [produto for produto, lojas in itens if not lojas]
+    if sem_loja:
+        raise HTTPException(422, {"erro": "nenhuma loja conhecida", "consultas": sem_loja[:20], "lojas": list(LOJAS)})
+    print(f"📦 BUSCA EM LOTE: {len(itens)} consultas{f' ({pedido.trabalho})' if pedido.trabalho else ''}")
+    if pedido.trabalho:
+        registros = gravar_lote(itens, os.path.join(PASTA_LOTES, f"{pedido.trabalho}.jsonl"))
+    else:
+        registros = buscar_lote(itens)
+
+    async def eventos():
+        async for registro in registros:
+            yield json_compacto(registro) + b"\n"
+
+    return StreamingResponse(eventos(), media_type="application/x-ndjson")
+
+@app.get("/api/historico")
+async def historico_preco(link: str, dias: float = Query(90, gt=0)):
+    """Preço atual, anterior, mínimo/máximo e a série de mudanças de preço de uma oferta."""
+    if not armazem.ativo: raise HTTPException(503, "banco de ofertas desligado")
+    dados = await armazem.historico(link, dias)
+    if dados is None: raise HTTPException(404, "oferta nunca vista")
+    return dados
+
+@app.get("/metrics")
+def metrics():
+    return PlainTextResponse(exportar_metricas(), media_type="text/plain; version=0.0.4")
 
 @app.get("/")
 def read_root():
     return FileResponse('index.html')
     
 if __name__ == "__main__":
-    uvicorn.run(app, host="127.0.0.1", port=8000)
\ No newline at end of file
+    if sys.argv[1:2] == ["lote"]:
+        asyncio.run(rodar_lote(sys.argv[2:]))
+    else:
+        uvicorn.run(app, host="127.0.0.1", port=8000)
\ No newline at end of file
@@ -0,0 +1,44 @@
+"""Testes de comportamento contra o replay local (bench/replay.py), sem Chromium e sem lojas de verdade.
+
+    python -m pytest -q
+
+O main lê a configuração ao ser importado, então o ambiente é montado aqui,
+antes de qualquer teste importar o módulo: todas as lojas por HTTP apontando
+para o replay, parse em thread e banco de ofertas em memória.
+"""
+import asyncio
+import os
+import sys
+
+import pytest
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(RAIZ, "bench"))
+sys.path.insert(0, RAIZ)
+
+from replay import iniciar_replay  # noqa: E402
+
+_, URL_REPLAY = iniciar_replay()
+os.environ.update({
+    "PRECIN_REPLAY_URL": URL_REPLAY,
+    "PRECIN_MODOS": "ml=http,amazon=http,kabum=http,magalu=http,pichau=http,terabyte=http",
+    "PRECIN_PARSE_EXECUTOR": "thread",
+    "PRECIN_BANCO": ":memory:",
+    "PRECIN_AQUECER_TOP": "0",
+})
+
+@pytest.fixture
+def rodar():
+    """Roda uma corrotina dentro do ciclo de vida da API, com cache e disjuntores zerados."""
+    import main
+
+    def _rodar(corrotina):
+        async def dentro():
+            async with main.lifespan(main.app):
+                return await corrotina
+
+        main.cache.limpar()
+        main._indices.clear()
+        for disjuntor in main.disjuntores.values(): disjuntor.sucesso()
+        return asyncio.run(dentro())
+    return _rodar
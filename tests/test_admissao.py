@@ -0,0 +1,86 @@
+import asyncio
+
+import httpx
+import pytest
+
+import main
+
+def cliente():
+    return httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://precin")
+
+def test_fila_cheia_recusa_e_espera_longa_estoura():
+    admissao = main.ControleAdmissao(limite=1, fila_max=1, espera_max=0.1)
+
+    async def cenario():
+        vaga = await admissao.entrar()
+        na_fila = asyncio.create_task(admissao.entrar())
+        await asyncio.sleep(0)
+        assert admissao.na_fila == 1
+        with pytest.raises(main.Sobrecarga) as cheia:
+            await admissao.entrar()
+        with pytest.raises(main.Sobrecarga) as estourou:
+            await na_fila
+        # Liberar duas vezes a mesma vaga não devolve vaga a mais
+        admissao.sair(vaga)
+        admissao.sair(vaga)
+        return cheia.value, estourou.value
+
+    cheia, estourou = asyncio.run(cenario())
+    assert (cheia.status, estourou.status) == (429, 503)
+    assert cheia.retry_after >= 1 and estourou.retry_after >= 1
+    assert (admissao.em_execucao, admissao.na_fila, admissao._semaforo._value) == (0, 0, 1)
+
+@pytest.mark.parametrize("fila_max,status", [(0, 429), (1, 503)])
+def test_sobrecarga_responde_com_retry_after(rodar, monkeypatch, fila_max, status):
+    monkeypatch.setattr(main, "admissao", main.ControleAdmissao(limite=1, fila_max=fila_max, espera_max=0.1))
+
+    async def cenario():
+        vaga = await main.admissao.entrar()
+        try:
+            async with cliente() as c:
+                return await c.get("/api/buscar", params={"q": "rtx 4060", "lojas": "kabum"})
+        finally:
+            main.admissao.sair(vaga)
+
+    resposta = rodar(cenario())
+    assert resposta.status_code == status
+    assert int(resposta.headers["Retry-After"]) == resposta.json()["retry_after"] >= 1
+
+def test_stream_devolve_a_vaga(rodar):
+    async def cenario():
+        async with cliente() as c:
+            resposta = await c.get("/api/buscar/stream", params={"q": "rtx 4060", "lojas": "kabum,pichau"})
+        return resposta, main.admissao.em_execucao
+
+    resposta, em_execucao = rodar(cenario())
+    assert resposta.status_code == 200 and '"tipo":"fim"' in resposta.text.splitlines()[-1]
+    assert em_execucao == 0 and main.admissao._semaforo._value == main.admissao.limite
+
+def test_cliente_que_cai_antes_do_corpo_devolve_a_vaga(rodar):
+    async def cenario():
+        resposta = await main.buscar_produtos_stream(q="rtx 4060", lojas="kabum", por_loja=None)
+        assert main.admissao.em_execucao == 1
+
+        async def receive(): return {"type": "http.disconnect"}
+        async def send(mensagem): raise OSError("conexão fechada")
+
+        with pytest.raises(Exception):
+            await resposta({"type": "http", "asgi": {"spec_version": "2.4"}, "method": "GET", "path": "/"}, receive, send)
+        return main.admissao.em_execucao
+
+    assert rodar(cenario()) == 0
+
+def test_refino_nao_raspa_nem_ocupa_vaga(rodar, monkeypatch):
+    async def cenario():
+        async with cliente() as c:
+            await c.get("/api/buscar/stream", params={"q": "rtx 4060", "lojas": "kabum"})
+            # Sem nenhuma vaga livre e sem fila, o refino ainda responde do que já foi buscado
+            monkeypatch.setattr(main, "admissao", main.ControleAdmissao(limite=1, fila_max=0))
+            await main.admissao.entrar()
+            antes = dict(main.METRICA_RASPAGENS.valores)
+            pagina = await c.get("/api/buscar", params={"q": "rtx 4060", "lojas": "kabum", "refino": 1, "pagina": 2, "limite": 10})
+            return pagina, antes
+
+    pagina, antes = rodar(cenario())
+    assert pagina.status_code == 200 and len(pagina.json()["produtos"]) == 10
+    assert main.METRICA_RASPAGENS.valores == antes
@@ -0,0 +1,22 @@
+import pytest
+
+import main
+from bench_matching import conferir_rotulados, ofertas_gravadas
+from replay import PASTA_FIXTURES
+
+@pytest.fixture(scope="module")
+def base():
+    return ofertas_gravadas(PASTA_FIXTURES)
+
+def test_pares_rotulados(base):
+    # Junto com as fixtures, para o peso das palavras ser o de uma busca de verdade
+    assert conferir_rotulados(base) == []
+
+def test_capacidade_em_qualquer_ordem():
+    assert main.assinatura_oferta("Galaxy A55 256GB 8GB RAM")[0] == main.assinatura_oferta("Galaxy A55 8GB RAM 256GB")[0]
+
+def test_agrupado_ordenado_pela_oferta_mostrada(base):
+    indice = main.IndiceResultados(sorted(base, key=lambda p: p['preco']))
+    for ordem, chave in main.ORDENACOES.items():
+        linhas = indice.pagina(ordem, 1, 1000, agrupar=True)["produtos"]
+        assert [chave(p) for p in linhas] == sorted(chave(p) for p in linhas)
@@ -0,0 +1,78 @@
+import asyncio
+
+import main
+
+def criar_cache(ttl=60, janela_stale=60):
+    return main.CacheResultados(ttl_por_loja={"loja": ttl}, janela_stale=janela_stale)
+
+class Carregador:
+    def __init__(self, atraso=0.05, falhar=False):
+        self.chamadas = 0
+        self.atraso = atraso
+        self.falhar = falhar
+
+    async def __call__(self):
+        self.chamadas += 1
+        await asyncio.sleep(self.atraso)
+        if self.falhar: raise RuntimeError("loja fora do ar")
+        return [{"versao": self.chamadas}]
+
+def test_buscas_simultaneas_dividem_uma_raspagem():
+    cache, carregar = criar_cache(), Carregador()
+
+    async def cenario():
+        return await asyncio.gather(*[cache.obter("loja", "RTX 4060", carregar) for _ in range(5)],
+                                    cache.obter("loja", "rtx  4060", carregar))
+
+    resultados = asyncio.run(cenario())
+    assert carregar.chamadas == 1
+    assert all(r is resultados[0] for r in resultados)
+
+def test_vencido_e_servido_enquanto_atualiza():
+    cache, carregar = criar_cache(ttl=0.3), Carregador()
+
+    async def cenario():
+        primeiro = await cache.obter("loja", "rtx 4060", carregar)
+        await asyncio.sleep(0.35)
+        # Vencido mas dentro da janela: volta na hora o antigo e dispara a atualização
+        vencido = await cache.obter("loja", "rtx 4060", carregar)
+        assert cache.em_voo("loja", "rtx 4060")
+        while cache.em_voo("loja", "rtx 4060"): await asyncio.sleep(0.01)
+        return primeiro, vencido, await cache.obter("loja", "rtx 4060", carregar)
+
+    primeiro, vencido, novo = asyncio.run(cenario())
+    assert vencido is primeiro and primeiro[0]["versao"] == 1
+    assert novo[0]["versao"] == 2 and carregar.chamadas == 2
+
+def test_fora_da_janela_espera_raspagem_nova():
+    cache, carregar = criar_cache(ttl=0.05, janela_stale=0.05), Carregador()
+
+    async def cenario():
+        await cache.obter("loja", "rtx 4060", carregar)
+        await asyncio.sleep(0.15)
+        return await cache.obter("loja", "rtx 4060", carregar)
+
+    assert asyncio.run(cenario())[0]["versao"] == 2
+
+def test_erro_nao_entra_no_cache():
+    cache, carregar = criar_cache(), Carregador(falhar=True)
+
+    async def cenario():
+        for _ in range(2):
+            try:
+                await cache.obter("loja", "rtx 4060", carregar)
+            except RuntimeError:
+                pass
+
+    asyncio.run(cenario())
+    assert carregar.chamadas == 2 and cache.restante("loja", "rtx 4060") is None
+
+def test_buscas_iguais_no_replay_raspam_uma_vez(rodar):
+    antes = main.METRICA_RASPAGENS.valores.get(("kabum", "ok"), 0)
+
+    async def cenario():
+        return await asyncio.gather(*[main.buscar_paralelo("rtx 4060", ["kabum"]) for _ in range(3)])
+
+    resultados = rodar(cenario())
+    assert main.METRICA_RASPAGENS.valores[("kabum", "ok")] - antes == 1
+    assert len(resultados[0]) > 0 and all(r == resultados[0] for r in resultados)
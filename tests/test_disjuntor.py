@@ -0,0 +1,83 @@
+import asyncio
+import gc
+import os
+import time
+
+import httpx
+
+import main
+
+def test_abre_depois_das_falhas_e_meio_abre_depois_do_resfriamento():
+    disjuntor = main.Disjuntor("loja", limite_falhas=2, resfriamento=0.1)
+    disjuntor.falha("timeout")
+    assert disjuntor.permitir()
+    disjuntor.falha("timeout")
+    assert disjuntor.aberto and not disjuntor.permitir()
+
+    time.sleep(0.15)
+    # Meio-aberto: uma tentativa passa, as outras esperam o resultado dela
+    assert disjuntor.permitir()
+    assert not disjuntor.permitir()
+    disjuntor.falha("erro")
+    assert disjuntor.aberto and not disjuntor.permitir()
+
+    time.sleep(0.15)
+    assert disjuntor.permitir()
+    disjuntor.sucesso()
+    assert not disjuntor.aberto and disjuntor.permitir() and disjuntor.permitir()
+
+def test_loja_fora_do_ar_abre_o_disjuntor_no_replay(rodar, monkeypatch):
+    # Prefixo que o replay não conhece: toda busca na Kabum volta 404
+    monkeypatch.setitem(main.ORIGENS, "kabum", os.environ["PRECIN_REPLAY_URL"] + "/sumiu")
+    monkeypatch.setattr(main.disjuntores["kabum"], "resfriamento", 0.2)
+
+    async def cenario():
+        status = []
+        for i in range(main.DISJUNTOR_LIMITE_FALHAS + 1):
+            relatorio = {}
+            await main.buscar_paralelo(f"rtx 4060 {i}", ["kabum"], relatorio=relatorio)
+            status.append(relatorio["kabum"])
+        # Resfriou e a loja voltou: a tentativa do meio-aberto fecha o disjuntor
+        await asyncio.sleep(0.25)
+        monkeypatch.undo()
+        relatorio = {}
+        resultados = await main.buscar_paralelo("rtx 4060 volta", ["kabum"], relatorio=relatorio)
+        return status, relatorio["kabum"], resultados
+
+    status, depois, resultados = rodar(cenario())
+    assert status == ["erro"] * main.DISJUNTOR_LIMITE_FALHAS + ["disjuntor"]
+    assert depois == "ok" and resultados and not main.disjuntores["kabum"].aberto
+
+def test_raspagem_que_falha_depois_do_prazo_nao_vaza_excecao(rodar, monkeypatch):
+    async def falha_lenta(pool, produto):
+        await asyncio.sleep(0.3)
+        raise RuntimeError("loja caiu depois do prazo")
+
+    monkeypatch.setitem(main.LOJAS, "terabyte", falha_lenta)
+    erros = []
+
+    async def cenario():
+        asyncio.get_running_loop().set_exception_handler(lambda loop, contexto: erros.append(contexto["message"]))
+        relatorio = {}
+        await main.buscar_paralelo("rtx 4060", ["terabyte"], prazo=0.1, relatorio=relatorio)
+        await asyncio.sleep(0.4)
+        gc.collect()
+        return relatorio
+
+    assert rodar(cenario()) == {"terabyte": "prazo"}
+    assert not [e for e in erros if "never retrieved" in e]
+
+def test_lojas_incompletas_vao_no_corpo_e_no_cabecalho_exposto(rodar, monkeypatch):
+    monkeypatch.setitem(main.ORIGENS, "terabyte", os.environ["PRECIN_REPLAY_URL"] + "/sumiu")
+
+    async def cenario():
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://precin") as c:
+            params = {"q": "rtx 4060", "lojas": "kabum,terabyte"}
+            busca = await c.get("/api/buscar", params=params, headers={"Origin": "http://outro.site"})
+            refino = await c.get("/api/buscar", params={**params, "refino": 1, "pagina": 2})
+        return busca, refino
+
+    busca, refino = rodar(cenario())
+    assert busca.json()["incompletas"] == {"terabyte": "erro"} == refino.json()["incompletas"]
+    assert busca.headers["X-Lojas-Incompletas"] == "terabyte=erro"
+    assert "x-lojas-incompletas" in busca.headers["Access-Control-Expose-Headers"].lower()
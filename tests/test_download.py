@@ -0,0 +1,32 @@
+import httpx
+import pytest
+
+import main
+from replay import iniciar_replay
+
+async def buscar_kabum(produto):
+    relatorio = {}
+    await main.buscar_paralelo(produto, ["kabum"], relatorio=relatorio)
+    return relatorio["kabum"]
+
+def test_http_lento_sai_como_timeout(rodar, monkeypatch):
+    servidor, url = iniciar_replay(atraso=600)
+    monkeypatch.setattr(main, "TIMEOUT_HTTP", 0.2)
+    monkeypatch.setitem(main.ORIGENS, "kabum", f"{url}/kabum")
+    try:
+        assert rodar(buscar_kabum("rtx 4060")) == "timeout"
+    finally:
+        servidor.shutdown()
+    assert main.disjuntores["kabum"].ultima_falha == "timeout"
+
+@pytest.mark.parametrize("codigo,status", [(429, "sobrecarga"), (503, "sobrecarga"), (403, "captcha")])
+def test_codigo_http_da_loja(rodar, monkeypatch, codigo, status):
+    cliente = httpx.AsyncClient(transport=httpx.MockTransport(lambda requisicao: httpx.Response(codigo)))
+    monkeypatch.setattr(main, "obter_cliente_http", lambda: cliente)
+    assert rodar(buscar_kabum("rtx 4060")) == status
+
+def test_pagina_de_checagem_de_robo_sai_como_captcha(rodar, monkeypatch):
+    pagina = "<html><head><title>Just a moment...</title></head><body></body></html>"
+    cliente = httpx.AsyncClient(transport=httpx.MockTransport(lambda requisicao: httpx.Response(200, text=pagina)))
+    monkeypatch.setattr(main, "obter_cliente_http", lambda: cliente)
+    assert rodar(buscar_kabum("rtx 4060")) == "captcha"
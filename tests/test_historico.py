@@ -0,0 +1,118 @@
+import httpx
+
+import main
+
+def precos_da_kabum(monkeypatch):
+    """Troca a raspagem da Kabum por uma que multiplica os preços do replay por `fator`."""
+    original = main.LOJAS["kabum"]
+    fator = {"valor": 1.0}
+
+    async def raspar(pool, produto):
+        resultados = await original(pool, produto)
+        # Sem o preço riscado da página, quem preenche `preco_antigo` é o banco
+        return [{**p, "preco": round(p["preco"] * fator["valor"], 2), "preco_antigo": None} for p in resultados]
+
+    monkeypatch.setitem(main.LOJAS, "kabum", raspar)
+    return fator
+
+def linha_no_banco(link):
+    return main.armazem._conexao.execute("SELECT preco, preco_anterior FROM ofertas WHERE link = ? AND loja = 'kabum'", (link,)).fetchone()
+
+def test_queda_de_preco_vira_preco_antigo_e_entra_no_historico(rodar, monkeypatch):
+    fator = precos_da_kabum(monkeypatch)
+
+    async def raspar_e_gravar():
+        resultados = await main.carregar_loja("kabum", "rtx 4060", usar_banco=False)
+        await main.armazem.descarregar()
+        return {p["link"]: p for p in resultados}
+
+    async def cenario():
+        primeira = await raspar_e_gravar()
+        link = next(iter(primeira))
+        gravado = linha_no_banco(link)
+        fator["valor"] = 0.9
+        queda = await raspar_e_gravar()
+        depois_da_queda = linha_no_banco(link)
+        # Raspar de novo com o mesmo preço não apaga o anterior nem repete a linha da série
+        mesma = await raspar_e_gravar()
+        depois_da_repeticao = linha_no_banco(link)
+        fator["valor"] = 1.0
+        alta = await raspar_e_gravar()
+        serie = await main.armazem.historico(link, 90)
+        return link, primeira, gravado, queda, depois_da_queda, mesma, depois_da_repeticao, alta, serie
+
+    link, primeira, gravado, queda, depois_da_queda, mesma, depois_da_repeticao, alta, serie = rodar(cenario())
+    preco, reduzido = primeira[link]["preco"], queda[link]["preco"]
+    assert primeira[link]["preco_antigo"] is None and gravado == (preco, None)
+    assert queda[link]["preco_antigo"] == preco and depois_da_queda == (reduzido, preco)
+    assert all(queda[l]["preco_antigo"] == primeira[l]["preco"] for l in queda if l in primeira)
+    assert mesma[link]["preco_antigo"] == preco and depois_da_repeticao == (reduzido, preco)
+    # Preço subiu: o anterior era menor, então não há "de/por"
+    assert alta[link]["preco_antigo"] is None
+    assert [p["preco"] for p in serie["precos"]] == [preco, reduzido, preco]
+    assert (serie["preco"], serie["preco_anterior"], serie["minimo"], serie["maximo"]) == (preco, reduzido, reduzido, preco)
+
+def test_busca_recente_sai_do_banco_com_a_idade_descontada_do_cache(rodar, monkeypatch):
+    fator = precos_da_kabum(monkeypatch)
+    ttl = main.TTL_POR_LOJA["kabum"]
+
+    async def cenario():
+        raspados = await main.carregar_loja("kabum", "RTX 4060")
+        fator["valor"] = 0.9
+        await main.cache.obter("kabum", "rtx 4060", lambda: main.carregar_loja("kabum", "rtx 4060", usar_banco=False))
+        await main.armazem.descarregar()
+        # Finge que a última raspagem foi há 100s
+        main.armazem._conexao.execute("UPDATE buscas SET visto_em = visto_em - 100")
+        main.cache.limpar()
+        raspagens = dict(main.METRICA_RASPAGENS.valores)
+        banco = main.METRICA_CACHE.valores.get(("kabum", "banco"), 0)
+        relatorio = {}
+        servidos = await main.buscar_paralelo("rtx  4060", ["kabum"], relatorio=relatorio)
+        guardados = main.cache._itens[("rtx 4060", "kabum")]["valor"]
+        restante = main.cache.restante("kabum", "rtx 4060")
+        lido = (raspagens == main.METRICA_RASPAGENS.valores, main.METRICA_CACHE.valores[("kabum", "banco")] - banco, relatorio["kabum"])
+        # Mais velha que o TTL da loja: raspa de novo em vez de servir do banco
+        main.armazem._conexao.execute("UPDATE buscas SET visto_em = visto_em - ?", (ttl,))
+        main.cache.limpar()
+        velha = await main.carregar_loja("kabum", "rtx 4060")
+        return raspados, servidos, guardados, restante, lido, velha, raspagens
+
+    raspados, servidos, guardados, restante, lido, velha, raspagens = rodar(cenario())
+    assert lido == (True, 1, "ok")
+    assert isinstance(guardados, main.OfertasGuardadas) and 100 <= guardados.idade < 110
+    assert ttl - guardados.idade - 5 < restante <= ttl - 100
+    assert len(servidos) == len(raspados)
+    # O que vem do banco já traz o "de/por" montado a partir do preço anterior
+    por_link = {p["link"]: p for p in raspados}
+    assert all(p["preco_antigo"] == por_link[p["link"]]["preco"] > p["preco"] for p in guardados)
+    assert not isinstance(velha, main.OfertasGuardadas)
+    assert main.METRICA_RASPAGENS.valores[("kabum", "ok")] == raspagens[("kabum", "ok")] + 1
+
+def test_api_historico(rodar, monkeypatch):
+    async def cenario():
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://precin") as c:
+            busca = await c.get("/api/buscar", params={"q": "rtx 4060", "lojas": "kabum"})
+            await main.armazem.descarregar()
+            oferta = busca.json()["produtos"][0]
+            visto = await c.get("/api/historico", params={"link": oferta["link"]})
+            nunca = await c.get("/api/historico", params={"link": "https://www.kabum.com.br/produto/0/nao-existe"})
+            invalido = await c.get("/api/historico", params={"link": oferta["link"], "dias": 0})
+        return oferta, visto, nunca, invalido
+
+    oferta, visto, nunca, invalido = rodar(cenario())
+    assert visto.status_code == 200
+    dados = visto.json()
+    assert (dados["link"], dados["preco"], dados["nome"]) == (oferta["link"], oferta["preco"], oferta["nome"])
+    assert dados["minimo"] == dados["maximo"] == oferta["preco"] and [p["preco"] for p in dados["precos"]] == [oferta["preco"]]
+    assert nunca.status_code == 404 and nunca.json()["detail"] == "oferta nunca vista"
+    assert invalido.status_code == 422
+
+    # Sem caminho de banco o armazém nem abre
+    monkeypatch.setattr(main, "armazem", main.ArmazemOfertas(caminho=""))
+
+    async def desligado():
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://precin") as c:
+            return await c.get("/api/historico", params={"link": oferta["link"]})
+
+    resposta = rodar(desligado())
+    assert resposta.status_code == 503 and resposta.json()["detail"] == "banco de ofertas desligado"
@@ -0,0 +1,76 @@
+import asyncio
+import json
+
+import httpx
+
+import main
+
+ITENS = [("rtx 4060", ["kabum"]), ("rtx 4070", ["kabum", "pichau"]), ("rtx 3060", ["kabum"])]
+
+async def coletar(itens, caminho):
+    return [r async for r in main.gravar_lote(itens, caminho)]
+
+def linhas_validas(caminho):
+    validas = []
+    for linha in open(caminho, "rb").read().splitlines():
+        try:
+            validas.append(json.loads(linha))
+        except ValueError:
+            pass
+    return validas
+
+def test_retoma_de_jsonl_cortado(rodar, tmp_path):
+    caminho = str(tmp_path / "lote.jsonl")
+    primeira = rodar(coletar(ITENS[:2], caminho))
+    assert [r["tipo"] for r in primeira] == ["consulta", "consulta", "fim"]
+    # Interrompido no meio da segunda linha (as consultas saem na ordem em que terminam)
+    linhas = open(caminho, "rb").read().splitlines(True)
+    cortada = json.loads(linhas[1])["consulta"]
+    open(caminho, "wb").write(linhas[0] + linhas[1][:40])
+
+    segunda = rodar(coletar(ITENS, caminho))
+    assert {r["consulta"] for r in segunda if r["tipo"] == "consulta"} == {cortada, "rtx 3060"}
+    assert segunda[-1]["puladas"] == 1
+    consultas = [r["consulta"] for r in linhas_validas(caminho) if r["tipo"] == "consulta"]
+    assert sorted(consultas) == ["rtx 3060", "rtx 4060", "rtx 4070"]
+    assert len(main.consultas_feitas(caminho)) == 3
+
+    terceira = rodar(coletar(ITENS, caminho))
+    assert [r["tipo"] for r in terceira] == ["fim"] and terceira[0]["puladas"] == 3
+
+def test_repetidas_no_lote_rodam_uma_vez(rodar, tmp_path):
+    fim = rodar(coletar([("RTX 4060", ["kabum"]), ("rtx  4060", ["kabum"])], str(tmp_path / "lote.jsonl")))[-1]
+    assert (fim["consultas"], fim["puladas"]) == (1, 1)
+
+def test_mesmo_trabalho_em_paralelo_nao_repete(rodar, tmp_path):
+    caminho = str(tmp_path / "lote.jsonl")
+
+    async def dois():
+        return await asyncio.gather(coletar(ITENS, caminho), coletar(ITENS, caminho))
+
+    a, b = rodar(dois())
+    assert a[-1]["consultas"] + b[-1]["consultas"] == len(ITENS)
+    assert len(linhas_validas(caminho)) == len(ITENS) + 2
+
+def test_lojas_sao_resolvidas_sem_diferenciar_caixa():
+    assert main.lojas_do_lote(" Kabum ,PICHAU") == ["kabum", "pichau"]
+    assert main.lojas_do_lote("kabun,xyz") == []
+    assert list(main.ler_itens_lote(["rtx 4060\tKabum\n", "rtx 4070\tkabun\n"])) == [("rtx 4060", ["kabum"]), ("rtx 4070", [])]
+
+def test_consulta_sem_loja_conhecida_nao_derruba_o_lote(rodar, tmp_path):
+    registros = rodar(coletar(main.ler_itens_lote(["rtx 4060\tkabun", "rtx 4070\tKabum"]), str(tmp_path / "lote.jsonl")))
+    assert [r["tipo"] for r in registros] == ["invalida", "consulta", "fim"]
+    assert registros[1]["lojas"] == "kabum" and registros[1]["completa"]
+    assert (registros[-1]["consultas"], registros[-1]["invalidas"]) == (1, 1)
+
+def test_api_recusa_lote_sem_loja_conhecida(rodar):
+    async def cenario():
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://precin") as c:
+            recusado = await c.post("/api/buscar/lote", json={"consultas": ["rtx 4060", {"q": "rtx 4070", "lojas": "kabun"}], "lojas": "kabum"})
+            aceito = await c.post("/api/buscar/lote", json={"consultas": ["rtx 4060"], "lojas": "Kabum"})
+        return recusado, aceito
+
+    recusado, aceito = rodar(cenario())
+    assert recusado.status_code == 422 and recusado.json()["detail"]["consultas"] == ["rtx 4070"]
+    linhas = [json.loads(l) for l in aceito.text.splitlines()]
+    assert aceito.status_code == 200 and [l["tipo"] for l in linhas] == ["consulta", "fim"] and linhas[0]["lojas"] == "kabum"